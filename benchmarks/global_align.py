@@ -0,0 +1,69 @@
+import argparse
+import time
+
+import numpy as np
+
+from auffusion.prompt2prompt.ptp_utils import (
+    ScoreParams,
+    get_matrix,
+    get_traceback_matrix,
+    global_align_batch,
+)
+
+
+def global_align_loop(x, y, score):
+    matrix = get_matrix(len(x), len(y), score.gap)
+    trace_back = get_traceback_matrix(len(x), len(y))
+    for i in range(1, len(x) + 1):
+        for j in range(1, len(y) + 1):
+            left = matrix[i, j - 1] + score.gap
+            up = matrix[i - 1, j] + score.gap
+            diag = matrix[i - 1, j - 1] + score.mis_match_char(x[i - 1], y[j - 1])
+            matrix[i, j] = max(left, up, diag)
+            if matrix[i, j] == left:
+                trace_back[i, j] = 1
+            elif matrix[i, j] == up:
+                trace_back[i, j] = 2
+            else:
+                trace_back[i, j] = 3
+    return matrix, trace_back
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--length", type=int, default=77)
+    parser.add_argument("--vocab-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    score = ScoreParams(0, 1, -1)
+
+    x = rng.integers(args.vocab_size, size=args.length).tolist()
+    ys = [
+        rng.integers(args.vocab_size, size=rng.integers(1, args.length + 1)).tolist()
+        for _ in range(args.batch_size)
+    ]
+
+    start = time.perf_counter()
+    expected = [global_align_loop(x, y, score) for y in ys]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matrices, trace_backs = global_align_batch([x] * len(ys), ys, score)
+    batch_time = time.perf_counter() - start
+
+    for y, (matrix, trace_back), batch_matrix, batch_trace_back in zip(
+        ys, expected, matrices, trace_backs
+    ):
+        size = (slice(None, len(x) + 1), slice(None, len(y) + 1))
+        assert np.array_equal(matrix, batch_matrix[size])
+        assert np.array_equal(trace_back, batch_trace_back[size])
+
+    print(f"loop:  {loop_time * 1000:.1f} ms")
+    print(f"batch: {batch_time * 1000:.1f} ms ({loop_time / batch_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
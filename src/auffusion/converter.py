@@ -51,88 +51,126 @@ mel_basis = {}
 hann_window = {}
 
 
-def mel_spectrogram(
-    y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False
-):
-    if torch.min(y) < -1.0:
-        print("min value is ", torch.min(y))
-    if torch.max(y) > 1.0:
-        print("max value is ", torch.max(y))
-
-    global mel_basis, hann_window
-    if fmax not in mel_basis:
-        mel = librosa_mel_fn(
-            sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax
+class SpectrogramFrontend(object):
+    def __init__(
+        self,
+        n_fft,
+        num_mels,
+        sampling_rate,
+        hop_size,
+        win_size,
+        fmin,
+        fmax,
+        center=False,
+        check_range=False,
+    ):
+        self.n_fft = n_fft
+        self.num_mels = num_mels
+        self.sampling_rate = sampling_rate
+        self.hop_size = hop_size
+        self.win_size = win_size
+        self.fmin = fmin
+        self.fmax = fmax
+        self.center = center
+        self.check_range = check_range
+        # The peak amplitude seen so far stays on the device until a caller reads it
+        self.max_amplitude = None
+
+    def get_mel_basis(self, device, dtype=torch.float32):
+        key = (
+            self.n_fft,
+            self.num_mels,
+            self.sampling_rate,
+            self.fmin,
+            self.fmax,
+            str(device),
+            dtype,
         )
-        mel_basis[str(fmax) + "_" + str(y.device)] = (
-            torch.from_numpy(mel).float().to(y.device)
+        if key not in mel_basis:
+            mel = librosa_mel_fn(
+                sr=self.sampling_rate,
+                n_fft=self.n_fft,
+                n_mels=self.num_mels,
+                fmin=self.fmin,
+                fmax=self.fmax,
+            )
+            mel_basis[key] = torch.from_numpy(mel).to(device=device, dtype=dtype)
+
+        return mel_basis[key]
+
+    def get_window(self, device, dtype=torch.float32):
+        key = (self.win_size, str(device), dtype)
+        if key not in hann_window:
+            hann_window[key] = torch.hann_window(
+                self.win_size, device=device, dtype=dtype
+            )
+
+        return hann_window[key]
+
+    def spectrogram(self, y):
+        if self.check_range:
+            # Samples beyond [-1, 1] show up as a peak above 1, without a sync here
+            max_amplitude = y.detach().abs().amax()
+            if self.max_amplitude is not None:
+                max_amplitude = torch.maximum(self.max_amplitude, max_amplitude)
+            self.max_amplitude = max_amplitude
+
+        # Any leading dimensions are batch dimensions
+        shape = y.shape[:-1]
+        y = y.reshape(-1, 1, y.shape[-1])
+
+        padding = int((self.n_fft - self.hop_size) / 2)
+        y = torch.nn.functional.pad(y, (padding, padding), mode="reflect")
+        y = y.squeeze(1)
+
+        # complex tensor as default, then use view_as_real for future pytorch compatibility
+        spec = torch.stft(
+            y,
+            self.n_fft,
+            hop_length=self.hop_size,
+            win_length=self.win_size,
+            window=self.get_window(y.device, y.dtype),
+            center=self.center,
+            pad_mode="reflect",
+            normalized=False,
+            onesided=True,
+            return_complex=True,
         )
-        hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+        spec = torch.view_as_real(spec)
+        spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
 
-    y = torch.nn.functional.pad(
-        y.unsqueeze(1),
-        (int((n_fft - hop_size) / 2), int((n_fft - hop_size) / 2)),
-        mode="reflect",
-    )
-    y = y.squeeze(1)
+        return spec.reshape(*shape, *spec.shape[1:])
 
-    # complex tensor as default, then use view_as_real for future pytorch compatibility
-    spec = torch.stft(
-        y,
-        n_fft,
-        hop_length=hop_size,
-        win_length=win_size,
-        window=hann_window[str(y.device)],
-        center=center,
-        pad_mode="reflect",
-        normalized=False,
-        onesided=True,
-        return_complex=True,
-    )
-    spec = torch.view_as_real(spec)
-    spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
+    def mel_spectrogram(self, y):
+        spec = self.spectrogram(y)
 
-    spec = torch.matmul(mel_basis[str(fmax) + "_" + str(y.device)], spec)
-    spec = spectral_normalize_torch(spec)
+        spec = torch.matmul(self.get_mel_basis(spec.device, spec.dtype), spec)
+        spec = spectral_normalize_torch(spec)
 
-    return spec
+        return spec
 
+    def __call__(self, y):
+        return self.mel_spectrogram(y)
 
-def spectrogram(
+
+def mel_spectrogram(
     y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False
 ):
-    if torch.min(y) < -1.0:
-        print("min value is ", torch.min(y))
-    if torch.max(y) > 1.0:
-        print("max value is ", torch.max(y))
-
-    global hann_window
-    hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
-
-    y = torch.nn.functional.pad(
-        y.unsqueeze(1),
-        (int((n_fft - hop_size) / 2), int((n_fft - hop_size) / 2)),
-        mode="reflect",
+    frontend = SpectrogramFrontend(
+        n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=center
     )
-    y = y.squeeze(1)
 
-    # complex tensor as default, then use view_as_real for future pytorch compatibility
-    spec = torch.stft(
-        y,
-        n_fft,
-        hop_length=hop_size,
-        win_length=win_size,
-        window=hann_window[str(y.device)],
-        center=center,
-        pad_mode="reflect",
-        normalized=False,
-        onesided=True,
-        return_complex=True,
+    return frontend.mel_spectrogram(y)
+
+
+def spectrogram(
+    y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False
+):
+    frontend = SpectrogramFrontend(
+        n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=center
     )
-    spec = torch.view_as_real(spec)
-    spec = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
 
-    return spec
+    return frontend.spectrogram(y)
 
 
 def normalize_spectrogram(
@@ -177,15 +215,17 @@ def denormalize_spectrogram(
     min_value = np.log(min_value)
 
     # Flip Y axis: image origin at the top-left corner, spectrogram origin at the bottom-left corner
-    data = torch.flip(data, [1])
-
-    assert len(data.shape) == 3, "Expected 3 dimensions, got {}".format(len(data.shape))
+    data = torch.flip(data, [-2])
 
-    if data.shape[0] == 1:
-        data = data.repeat(3, 1, 1)
+    # A leading dimension denormalizes a whole batch at once
+    assert len(data.shape) in (3, 4), "Expected 3 or 4 dimensions, got {}".format(
+        len(data.shape)
+    )
 
-    assert data.shape[0] == 3, "Expected 3 channels, got {}".format(data.shape[0])
-    data = data[0]
+    assert data.shape[-3] in (1, 3), "Expected 1 or 3 channels, got {}".format(
+        data.shape[-3]
+    )
+    data = data[..., 0, :, :]
 
     # Reverse the power curve
     data = torch.pow(data, 1 / power)
@@ -487,6 +527,19 @@ class Generator(torch.nn.Module):
         vocoder.remove_weight_norm()
         return vocoder
 
+    @torch.no_grad()
+    def synthesize(self, mels, dtype=torch.int16):
+        self.eval()
+        wavs = self(mels.to(self.conv_pre.weight.dtype)).squeeze(1)
+
+        # Quantize on the device, so that only the final PCM is ever copied back
+        if dtype.is_floating_point:
+            return wavs.to(dtype)
+
+        # A full-scale sample would otherwise wrap around to the opposite sign
+        info = torch.iinfo(dtype)
+        return (wavs * MAX_WAV_VALUE).clamp(info.min, info.max).to(dtype)
+
     @torch.no_grad()
     def inference(self, mels, lengths=None):
         self.eval()
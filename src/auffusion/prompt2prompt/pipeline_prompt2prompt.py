@@ -1,6 +1,7 @@
 from typing import Callable, List, Optional, Union
 import numpy as np
 import torch
+from diffusers.pipelines.pipeline_utils import AudioPipelineOutput
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 from diffusers.models.cross_attention import CrossAttention
 
@@ -8,7 +9,12 @@ from diffusers.models.cross_attention import CrossAttention
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipeline
 import matplotlib.pyplot as plt
 
-from auffusion.prompt2prompt.ptp_utils import AttentionStore
+from auffusion.converter import Generator, denormalize_spectrogram
+from auffusion.prompt2prompt.ptp_utils import (
+    AttentionControlEdit,
+    AttentionStore,
+    SourceTrajectory,
+)
 import auffusion.prompt2prompt.ptp_utils as ptp_utils
 from PIL import Image
 
@@ -59,6 +65,10 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
         return_dict: bool = True,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[int] = 1,
+        vocoder: Optional[Generator] = None,
+        audio_dtype: torch.dtype = torch.int16,
+        max_attention_size: Optional[int] = None,
+        source_trajectory: Optional[SourceTrajectory] = None,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -96,7 +106,8 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
                 tensor will ge generated by sampling using the supplied random `generator`.
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generate image. Choose between
-                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
+                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`. `"audio"` skips the
+                safety checker and vocodes the spectrograms of the whole batch on the device instead.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
                 plain tuple.
@@ -106,6 +117,20 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            vocoder (`Generator`, *optional*):
+                The vocoder that turns the denormalized spectrograms into waveforms. Required when `output_type` is
+                `"audio"`.
+            audio_dtype (`torch.dtype`, *optional*, defaults to `torch.int16`):
+                The PCM format of the waveforms when `output_type` is `"audio"`. A floating point type keeps the samples
+                in `[-1, 1]`.
+            max_attention_size (`int`, *optional*):
+                The most attention scores per batch row and head that any layer materializes at once. Layers with more
+                scores attend in chunks of queries, and the controller is called once per chunk, so that peak memory
+                does not grow with the spectrogram width.
+            source_trajectory (`SourceTrajectory`, *optional*):
+                Caches the denoising of the first prompt. The first call records its latents and the attention maps
+                that `controller` needs. Later calls with the same source prompt, initial latents and sampling settings
+                only denoise the edited prompts. Requires an `AttentionControlEdit` controller.
 
         Returns:
             [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] or `tuple`:
@@ -115,7 +140,21 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
             (nsfw) content, according to the `safety_checker`.
         """
 
-        self.register_attention_control(controller)  # add attention controller
+        if output_type == "audio" and vocoder is None:
+            raise ValueError("A `vocoder` is required when `output_type` is 'audio'")
+
+        if source_trajectory is not None and (
+            not isinstance(controller, AttentionControlEdit)
+            or num_images_per_prompt != 1
+        ):
+            raise ValueError(
+                "A `source_trajectory` requires an `AttentionControlEdit` controller"
+                " and a single image per prompt"
+            )
+
+        self.register_attention_control(
+            controller, max_attention_size=max_attention_size
+        )  # add attention controller
 
         # 0. Default height and width to unet
         height = height or self.unet.config.sample_size * self.vae_scale_factor
@@ -161,10 +200,49 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
         # 6. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
+        # The source row is dropped from the batch when its trajectory is cached
+        replay = False
+        if isinstance(controller, AttentionControlEdit):
+            controller.trajectory = source_trajectory
+        if source_trajectory is not None:
+            source_rows = [0, batch_size] if do_classifier_free_guidance else [0]
+            key = (
+                num_inference_steps,
+                guidance_scale,
+                eta,
+                type(self.scheduler).__name__,
+                dict(self.scheduler.config),
+            )
+            inputs = (latents[:1], text_embeddings[source_rows])
+
+            replay = source_trajectory.matches(key, *inputs)
+            if replay:
+                text_rows = [
+                    i for i in range(text_embeddings.shape[0]) if i not in source_rows
+                ]
+                text_embeddings = text_embeddings[text_rows]
+            else:
+                source_trajectory.record(*inputs)
+            source_trajectory.is_replaying = replay
+
+        controller.latent_size = (
+            height // self.vae_scale_factor,
+            width // self.vae_scale_factor,
+        )
+
+        # The edit schedules follow the scheduler's denoising steps rather than the
+        # UNet calls, which higher-order schedulers make several of per step
+        controller.num_steps = num_inference_steps
+
         # 7. Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
+                controller.denoising_step = i // self.scheduler.order
+
+                if replay:
+                    latents = latents[1:]
+
                 # expand the latents if we are doing classifier free guidance
                 latent_model_input = (
                     torch.cat([latents] * 2) if do_classifier_free_guidance else latents
@@ -190,6 +268,11 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
                     noise_pred, t, latents, **extra_step_kwargs
                 ).prev_sample
 
+                if replay:
+                    latents = torch.cat([source_trajectory.latents[i], latents])
+                elif source_trajectory is not None:
+                    source_trajectory.latents.append(latents[:1].clone())
+
                 # step callback
                 latents = controller.step_callback(latents)
 
@@ -201,7 +284,18 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
                     if callback is not None and i % callback_steps == 0:
                         callback(i, t, latents)
 
+        if source_trajectory is not None:
+            source_trajectory.key = key
+
         # 8. Post-processing
+        if output_type == "audio":
+            audios = self.decode_audio(latents, vocoder, audio_dtype)
+
+            if not return_dict:
+                return (audios,)
+
+            return AudioPipelineOutput(audios=audios)
+
         image = self.decode_latents(latents)
 
         # 9. Run safety checker
@@ -220,7 +314,16 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
             images=image, nsfw_content_detected=has_nsfw_concept
         )
 
-    def register_attention_control(self, controller):
+    def decode_audio(self, latents, vocoder, dtype=torch.int16):
+        latents = 1 / self.vae.config.scaling_factor * latents
+        spectrograms = self.vae.decode(latents, return_dict=False)[0]
+        spectrograms = (spectrograms / 2 + 0.5).clamp(0, 1)
+
+        spectrograms = denormalize_spectrogram(spectrograms.float())
+
+        return vocoder.synthesize(spectrograms, dtype=dtype)
+
+    def register_attention_control(self, controller, max_attention_size=None):
         attn_procs = {}
         cross_att_count = 0
         for name in self.unet.attn_processors.keys():
@@ -246,7 +349,9 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
                 continue
             cross_att_count += 1
             attn_procs[name] = P2PCrossAttnProcessor(
-                controller=controller, place_in_unet=place_in_unet
+                controller=controller,
+                place_in_unet=place_in_unet,
+                max_attention_size=max_attention_size,
             )
 
         self.unet.set_attn_processor(attn_procs)
@@ -383,10 +488,11 @@ class Prompt2PromptPipeline(StableDiffusionPipeline):
 
 
 class P2PCrossAttnProcessor:
-    def __init__(self, controller, place_in_unet):
+    def __init__(self, controller, place_in_unet, max_attention_size=None):
         super().__init__()
         self.controller = controller
         self.place_in_unet = place_in_unet
+        self.max_attention_size = max_attention_size
 
     def __call__(
         self,
@@ -415,12 +521,40 @@ class P2PCrossAttnProcessor:
         key = attn.head_to_batch_dim(key)
         value = attn.head_to_batch_dim(value)
 
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
+        num_queries = query.shape[1]
+        chunk_size = num_queries
+        if self.max_attention_size is not None:
+            chunk_size = max(1, self.max_attention_size // key.shape[1])
+
+        if chunk_size >= num_queries:
+            attention_probs = attn.get_attention_scores(query, key, attention_mask)
+
+            # one line change
+            self.controller(attention_probs, is_cross, self.place_in_unet)
+
+            hidden_states = torch.bmm(attention_probs, value)
+        else:
+            hidden_states = query.new_empty(*query.shape[:2], value.shape[-1])
+            for start in range(0, num_queries, chunk_size):
+                query_slice = slice(start, min(start + chunk_size, num_queries))
+
+                mask = attention_mask
+                if mask is not None and mask.shape[1] > 1:
+                    mask = mask[:, query_slice]
+
+                attention_probs = attn.get_attention_scores(
+                    query[:, query_slice], key, mask
+                )
+                self.controller(
+                    attention_probs,
+                    is_cross,
+                    self.place_in_unet,
+                    query_slice=query_slice,
+                    num_queries=num_queries,
+                )
 
-        # one line change
-        self.controller(attention_probs, is_cross, self.place_in_unet)
+                hidden_states[:, query_slice] = torch.bmm(attention_probs, value)
 
-        hidden_states = torch.bmm(attention_probs, value)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -9,6 +9,8 @@ from typing import Union, Tuple, List, Dict, Optional
 import torch.nn.functional as nnf
 from PIL import ImageDraw, ImageFont
 
+from editgen._alignment import get_alignment
+
 
 # def text_under_image(image: np.ndarray, text: str, text_color: Tuple[int, int, int] = (0, 0, 0)) -> np.ndarray:
 #     h, w, c = image.shape
@@ -186,10 +188,27 @@ class AttentionControl(abc.ABC):
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         raise NotImplementedError
 
-    def __call__(self, attn, is_cross: bool, place_in_unet: str):
+    def __call__(
+        self,
+        attn,
+        is_cross: bool,
+        place_in_unet: str,
+        query_slice: Optional[slice] = None,
+        num_queries: Optional[int] = None,
+    ):
+        self.num_queries = attn.shape[1] if num_queries is None else num_queries
+        self.query_slice = (
+            slice(0, self.num_queries) if query_slice is None else query_slice
+        )
+
         if self.cur_att_layer >= self.num_uncond_att_layers:
             h = attn.shape[0]
             attn[h // 2 :] = self.forward(attn[h // 2 :], is_cross, place_in_unet)
+
+        # A chunked layer is called once per slice of its queries
+        if self.query_slice.stop < self.num_queries:
+            return attn
+
         self.cur_att_layer += 1
         if self.cur_att_layer == self.num_att_layers + self.num_uncond_att_layers:
             self.cur_att_layer = 0
@@ -200,11 +219,16 @@ class AttentionControl(abc.ABC):
     def reset(self):
         self.cur_step = 0
         self.cur_att_layer = 0
+        self.denoising_step = None
 
     def __init__(self):
         self.cur_step = 0
         self.num_att_layers = -1
         self.cur_att_layer = 0
+        self.denoising_step = None
+        self.latent_size = None
+        self.query_slice = None
+        self.num_queries = 0
 
 
 class EmptyControl(AttentionControl):
@@ -226,55 +250,132 @@ class AttentionStore(AttentionControl):
 
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-        if attn.shape[1] <= 32**2:  # avoid memory overhead
-            self.step_store[key].append(attn)
+        if self.num_queries <= 32**2:  # avoid memory overhead
+            self.accumulate(key, attn)
         return attn
 
-    def between_steps(self):
-        if len(self.attention_store) == 0:
-            self.attention_store = self.step_store
+    def accumulate(self, key, attn):
+        num_steps = self.cur_step + 1
+        factor = self.resolution_factor
+
+        # Every buffer holds the running average of its layer, so that it can be
+        # served as it is
+        if self.query_slice.start == 0:
+            if self.cur_att_layer not in self.attention_buffers:
+                buffer = attn.new_zeros(
+                    attn.shape[0],
+                    self.num_queries // factor**2,
+                    attn.shape[2],
+                    dtype=self.store_dtype or attn.dtype,
+                )
+                self.attention_buffers[self.cur_att_layer] = buffer
+                self.attention_store[key].append(buffer)
+            self.attention_buffers[self.cur_att_layer].mul_((num_steps - 1) / num_steps)
+
+        buffer = self.attention_buffers[self.cur_att_layer]
+        attn = attn.to(buffer.dtype)
+        if factor == 1:
+            buffer[:, self.query_slice].add_(attn, alpha=1 / num_steps)
         else:
-            for key in self.attention_store:
-                for i in range(len(self.attention_store[key])):
-                    self.attention_store[key][i] += self.step_store[key][i]
-        self.step_store = self.get_empty_store()
+            index = self.get_pooling_index(self.num_queries, buffer.device)
+            buffer.index_add_(
+                1, index[self.query_slice], attn, alpha=1 / (num_steps * factor**2)
+            )
+
+    def get_pooling_index(self, num_queries, device):
+        if num_queries not in self.pooling_indices:
+            height, width = get_attention_resolution(num_queries, self.latent_size)
+            factor = self.resolution_factor
+            if height % factor or width % factor:
+                raise ValueError(
+                    f"A {height}x{width} attention map cannot be pooled by {factor}"
+                )
+            rows = torch.arange(height, device=device) // factor
+            cols = torch.arange(width, device=device) // factor
+            self.pooling_indices[num_queries] = (
+                rows[:, None] * (width // factor) + cols[None, :]
+            ).flatten()
+        return self.pooling_indices[num_queries]
 
     def get_average_attention(self):
         average_attention = {
-            key: [item / self.cur_step for item in self.attention_store[key]]
-            for key in self.attention_store
+            key: list(self.attention_store[key]) for key in self.attention_store
         }
         return average_attention
 
     def reset(self):
         super(AttentionStore, self).reset()
-        self.step_store = self.get_empty_store()
-        self.attention_store = {}
+        self.attention_store = self.get_empty_store()
+        self.attention_buffers = {}
 
-    def __init__(self):
+    def __init__(self, store_dtype=None, resolution_factor: int = 1):
         super(AttentionStore, self).__init__()
-        self.step_store = self.get_empty_store()
-        self.attention_store = {}
+        self.store_dtype = store_dtype
+        self.resolution_factor = resolution_factor
+        self.attention_store = self.get_empty_store()
+        self.attention_buffers = {}
+        self.pooling_indices = {}
+
+
+def get_attention_resolution(num_queries, latent_size):
+    if latent_size is None:
+        raise ValueError("The latent size of the attention maps is unknown")
+    # Every level of the UNet halves the latents, rounding up
+    height, width = latent_size
+    while height * width > num_queries:
+        height, width = (height + 1) // 2, (width + 1) // 2
+    if height * width != num_queries:
+        raise ValueError(f"{num_queries} queries do not match a {latent_size} latent")
+    return height, width
 
 
 class LocalBlend:
     def __call__(self, x_t, attention_store):
+        if self.mask_sum is None:
+            resolution = "the blending resolution"
+            if self.resolution is not None:
+                resolution = "{}x{}".format(*self.resolution)
+            raise ValueError(
+                f"No down or up cross-attention layer attends at {resolution}, "
+                f"check `resolution_factor` ({self.resolution_factor}) against the UNet"
+            )
+
         k = 1
-        maps = attention_store["down_cross"][2:4] + attention_store["up_cross"][:3]
-        maps = [
-            item.reshape(self.alpha_layers.shape[0], -1, 1, 16, 16, self.max_num_words)
-            for item in maps
-        ]
-        maps = torch.cat(maps, dim=1)
-        maps = (maps * self.alpha_layers).sum(-1).mean(1)
+        maps = self.mask_sum.reshape(-1, 1, *self.resolution)
         mask = nnf.max_pool2d(maps, (k * 2 + 1, k * 2 + 1), (1, 1), padding=(k, k))
         mask = nnf.interpolate(mask, size=(x_t.shape[2:]))
-        mask = mask / mask.max(2, keepdims=True)[0].max(3, keepdims=True)[0]
+        mask = mask / mask.amax(dim=(2, 3), keepdim=True)
         mask = mask.gt(self.threshold)
-        mask = (mask[:1] + mask[1:]).float()
+        mask = (mask[:1] + mask[1:]).to(x_t.dtype)
         x_t = x_t[:1] + mask * (x_t - x_t[:1])
         return x_t
 
+    def update(self, attn, place_in_unet, query_slice, num_queries, latent_size):
+        # Only the down and up cross-attention layers at the blending resolution
+        if place_in_unet == "mid":
+            return
+        if self.resolution is None:
+            height, width = latent_size
+            for _ in range(self.resolution_factor.bit_length() - 1):
+                height, width = (height + 1) // 2, (width + 1) // 2
+            self.resolution = height, width
+        if num_queries != self.resolution[0] * self.resolution[1]:
+            return
+
+        batch_size = self.alpha_layers.shape[0]
+        if self.mask_sum is None:
+            self.mask_sum = attn.new_zeros(batch_size, num_queries, dtype=torch.float32)
+
+        # The word maps of every head, summed over the layers and steps
+        maps = attn.reshape(batch_size, -1, *attn.shape[1:])
+        self.mask_sum[:, query_slice] += torch.einsum(
+            "bhqw,bw->bq", maps, self.alpha_layers.to(maps.dtype)
+        )
+
+    def reset(self):
+        self.resolution = None
+        self.mask_sum = None
+
     def __init__(
         self,
         prompts: List[str],
@@ -284,18 +385,60 @@ class LocalBlend:
         dtype=torch.float32,
         threshold=0.3,
         max_num_words=77,
+        resolution_factor: int = 4,
     ):
         self.max_num_words = 77
 
-        alpha_layers = torch.zeros(len(prompts), 1, 1, 1, 1, self.max_num_words)
+        alpha_layers = torch.zeros(len(prompts), self.max_num_words)
         for i, (prompt, words_) in enumerate(zip(prompts, words)):
             if type(words_) is str:
                 words_ = [words_]
             for word in words_:
                 ind = get_word_inds(prompt, word, tokenizer)
-                alpha_layers[i, :, :, :, :, ind] = 1
+                alpha_layers[i, ind] = 1
         self.alpha_layers = alpha_layers.to(device, dtype)
         self.threshold = threshold
+        # The maps are blended at the latent size downsampled by this factor
+        self.resolution_factor = resolution_factor
+        self.resolution = None
+        self.mask_sum = None
+
+
+class SourceTrajectory:
+    def matches(self, key, *inputs):
+        return (
+            self.key is not None
+            and self.key == key
+            and all(torch.equal(a, b) for a, b in zip(self.inputs, inputs))
+        )
+
+    def record(self, *inputs):
+        # The key is only set once the whole trajectory has been recorded
+        self.key = None
+        self.inputs = [item.clone() for item in inputs]
+        self.latents = []
+        self.attention = {}
+        self.is_replaying = False
+
+    def record_attention(self, step, layer, query_slice, num_queries, attn):
+        if query_slice.start == 0:
+            self.attention[step, layer] = attn.new_empty(
+                attn.shape[0], num_queries, attn.shape[2]
+            )
+        self.attention[step, layer][:, query_slice] = attn
+
+    def get_attention(self, step, layer, query_slice):
+        attn = self.attention.get((step, layer))
+        if attn is None:
+            return None
+        return attn[:, query_slice]
+
+    def __init__(self):
+        self.key = None
+        self.inputs = []
+        self.latents = []
+        self.attention = {}
+        self.is_replaying = False
 
 
 class AttentionControlEdit(AttentionStore, abc.ABC):
@@ -305,7 +448,7 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
         return x_t
 
     def replace_self_attention(self, attn_base, att_replace):
-        if att_replace.shape[2] <= 16**2:
+        if self.num_queries <= 16**2:
             return attn_base.unsqueeze(0).expand(att_replace.shape[0], *attn_base.shape)
         else:
             return att_replace
@@ -315,16 +458,46 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
         raise NotImplementedError
 
     def forward(self, attn, is_cross: bool, place_in_unet: str):
-        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
+        if self.trajectory is None:
+            return self.edit_attention(attn, is_cross, place_in_unet)
+
+        if not self.trajectory.is_replaying:
+            # Only the maps that AttentionStore keeps or that get edited
+            if is_cross or self.num_queries <= 32**2:
+                h = attn.shape[0] // self.batch_size
+                self.trajectory.record_attention(
+                    self.cur_step,
+                    self.cur_att_layer,
+                    self.query_slice,
+                    self.num_queries,
+                    attn[:h],
+                )
+            return self.edit_attention(attn, is_cross, place_in_unet)
+
+        # The source row was not denoised again, so its cached maps take its place
+        attn_base = self.trajectory.get_attention(
+            self.cur_step, self.cur_att_layer, self.query_slice
+        )
+        if attn_base is None:
+            return attn
+
+        attn = torch.cat([attn_base, attn])
+        attn = self.edit_attention(attn, is_cross, place_in_unet)
+        return attn[attn_base.shape[0] :]
+
+    def edit_attention(self, attn, is_cross: bool, place_in_unet: str):
+        step = self.get_step()
+        num_self_replace = (
+            int(self.num_steps * self.self_replace_steps[0]),
+            int(self.num_steps * self.self_replace_steps[1]),
+        )
         # FIXME not replace correctly
-        if is_cross or (
-            self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]
-        ):
+        if is_cross or (num_self_replace[0] <= step < num_self_replace[1]):
             h = attn.shape[0] // (self.batch_size)
             attn = attn.reshape(self.batch_size, h, *attn.shape[1:])
             attn_base, attn_repalce = attn[0], attn[1:]
             if is_cross:
-                alpha_words = self.cross_replace_alpha[self.cur_step]
+                alpha_words = self.get_cross_replace_alpha(step)
                 attn_repalce_new = (
                     self.replace_cross_attention(attn_base, attn_repalce) * alpha_words
                     + (1 - alpha_words) * attn_repalce
@@ -333,7 +506,35 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
             else:
                 attn[1:] = self.replace_self_attention(attn_base, attn_repalce)
             attn = attn.reshape(self.batch_size * h, *attn.shape[2:])
-        return attn
+        if is_cross and self.local_blend is not None:
+            self.local_blend.update(
+                attn,
+                place_in_unet,
+                self.query_slice,
+                self.num_queries,
+                self.latent_size,
+            )
+        # The edited maps are the ones that get stored
+        return super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
+
+    def reset(self):
+        super(AttentionControlEdit, self).reset()
+        if self.local_blend is not None:
+            self.local_blend.reset()
+
+    def get_step(self):
+        # Higher-order schedulers call the UNet more than once per denoising step
+        if self.denoising_step is None:
+            return self.cur_step
+        return self.denoising_step
+
+    def get_cross_replace_alpha(self, step):
+        # The pipeline may run a different number of steps than the controller expects
+        if self.cross_replace_alpha.shape[0] != self.num_steps + 1:
+            self.cross_replace_alpha = get_time_words_attention_alpha(
+                self.prompts, self.num_steps, self.cross_replace_steps, self.tokenizer
+            ).to(self.device, self.dtype)
+        return self.cross_replace_alpha[step]
 
     def __init__(
         self,
@@ -356,16 +557,20 @@ class AttentionControlEdit(AttentionStore, abc.ABC):
         self.dtype = dtype
 
         self.batch_size = len(prompts)
+        # The schedules are fractions of the denoising steps
+        self.prompts = prompts
+        self.num_steps = num_steps
+        self.cross_replace_steps = cross_replace_steps
         self.cross_replace_alpha = get_time_words_attention_alpha(
             prompts, num_steps, cross_replace_steps, self.tokenizer
         ).to(self.device, self.dtype)
         if type(self_replace_steps) is float:
             self_replace_steps = 0, self_replace_steps
-        self.num_self_replace = (
-            int(num_steps * self_replace_steps[0]),
-            int(num_steps * self_replace_steps[1]),
-        )
+        self.self_replace_steps = self_replace_steps
         self.local_blend = local_blend  # 在外面定义后传进来
+        if self.local_blend is not None:
+            self.local_blend.reset()
+        self.trajectory = None
 
 
 class AttentionReplace(AttentionControlEdit):
@@ -579,20 +784,47 @@ def get_traceback_matrix(size_x, size_y):
 
 
 def global_align(x, y, score):
-    matrix = get_matrix(len(x), len(y), score.gap)
-    trace_back = get_traceback_matrix(len(x), len(y))
-    for i in range(1, len(x) + 1):
-        for j in range(1, len(y) + 1):
-            left = matrix[i, j - 1] + score.gap
-            up = matrix[i - 1, j] + score.gap
-            diag = matrix[i - 1, j - 1] + score.mis_match_char(x[i - 1], y[j - 1])
-            matrix[i, j] = max(left, up, diag)
-            if matrix[i, j] == left:
-                trace_back[i, j] = 1
-            elif matrix[i, j] == up:
-                trace_back[i, j] = 2
-            else:
-                trace_back[i, j] = 3
+    matrix, trace_back = global_align_batch([x], [y], score)
+    return matrix[0, : len(x) + 1, : len(y) + 1], trace_back[
+        0, : len(x) + 1, : len(y) + 1
+    ]
+
+
+def global_align_batch(xs, ys, score):
+    """Aligns many pairs at once, filling one anti-diagonal of every matrix per step."""
+    # Padding cells never feed back into the cells within a pair's own bounds
+    batch_size = len(xs)
+    size_x = max(len(x) for x in xs)
+    size_y = max(len(y) for y in ys)
+
+    x_ids = np.full((batch_size, size_x), -1, dtype=np.int64)
+    y_ids = np.full((batch_size, size_y), -2, dtype=np.int64)
+    for b, (x, y) in enumerate(zip(xs, ys)):
+        x_ids[b, : len(x)] = x
+        y_ids[b, : len(y)] = y
+
+    scores = np.where(
+        x_ids[:, :, None] == y_ids[:, None, :], score.match, score.mismatch
+    ).astype(np.int32)
+
+    matrix = np.repeat(get_matrix(size_x, size_y, score.gap)[None], batch_size, axis=0)
+    trace_back = np.repeat(
+        get_traceback_matrix(size_x, size_y)[None], batch_size, axis=0
+    )
+
+    for d in range(2, size_x + size_y + 1):
+        i = np.arange(max(1, d - size_y), min(size_x, d - 1) + 1)
+        j = d - i
+
+        left = matrix[:, i, j - 1] + score.gap
+        up = matrix[:, i - 1, j] + score.gap
+        diag = matrix[:, i - 1, j - 1] + scores[:, i - 1, j - 1]
+
+        best = np.maximum(np.maximum(left, up), diag)
+        matrix[:, i, j] = best
+        # Same tie-breaking as the scalar recurrence: left, then up, then diagonal
+        trace_back[:, i, j] = np.where(best == left, 1, np.where(best == up, 2, 3))
+
     return matrix, trace_back
 
 
@@ -625,10 +857,14 @@ def get_aligned_sequences(x, y, trace_back):
 
 
 def get_mapper(x: str, y: str, tokenizer, max_len=77):
-    x_seq = tokenizer.encode(x)
-    y_seq = tokenizer.encode(y)
+    x_seq = get_alignment(tokenizer, x).input_ids
+    y_seq = get_alignment(tokenizer, y).input_ids
     score = ScoreParams(0, 1, -1)
     matrix, trace_back = global_align(x_seq, y_seq, score)
+    return get_mapper_from_trace_back(x_seq, y_seq, trace_back, max_len)
+
+
+def get_mapper_from_trace_back(x_seq, y_seq, trace_back, max_len=77):
     mapper_base = get_aligned_sequences(x_seq, y_seq, trace_back)[-1]
     alphas = torch.ones(max_len)
     alphas[: mapper_base.shape[0]] = mapper_base[:, 1].ne(-1).float()
@@ -639,36 +875,20 @@ def get_mapper(x: str, y: str, tokenizer, max_len=77):
 
 
 def get_refinement_mapper(prompts, tokenizer, max_len=77):
-    x_seq = prompts[0]
+    x_seq = get_alignment(tokenizer, prompts[0]).input_ids
+    y_seqs = [get_alignment(tokenizer, prompt).input_ids for prompt in prompts[1:]]
+    score = ScoreParams(0, 1, -1)
+    _, trace_backs = global_align_batch([x_seq] * len(y_seqs), y_seqs, score)
     mappers, alphas = [], []
-    for i in range(1, len(prompts)):
-        mapper, alpha = get_mapper(x_seq, prompts[i], tokenizer, max_len)
+    for y_seq, trace_back in zip(y_seqs, trace_backs):
+        mapper, alpha = get_mapper_from_trace_back(x_seq, y_seq, trace_back, max_len)
         mappers.append(mapper)
         alphas.append(alpha)
     return torch.stack(mappers), torch.stack(alphas)
 
 
 def get_word_inds(text: str, word_place: int, tokenizer):
-    split_text = text.split(" ")
-    if type(word_place) is str:
-        word_place = [i for i, word in enumerate(split_text) if word_place == word]
-    elif type(word_place) is int:
-        word_place = [word_place]
-    out = []
-    if len(word_place) > 0:
-        words_encode = [
-            tokenizer.decode([item]).strip("#") for item in tokenizer.encode(text)
-        ][1:-1]
-        cur_len, ptr = 0, 0
-
-        for i in range(len(words_encode)):
-            cur_len += len(words_encode[i])
-            if ptr in word_place:
-                out.append(i + 1)
-            if cur_len >= len(split_text[ptr]):
-                ptr += 1
-                cur_len = 0
-    return np.array(out)
+    return get_alignment(tokenizer, text).get_word_indices(word_place)
 
 
 def get_replacement_mapper_(x: str, y: str, tokenizer, max_len=77):
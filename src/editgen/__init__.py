@@ -1 +1,3 @@
 from editgen._model import ModelProxy, EditGenPipeline
+from editgen._prompt_cache import PromptCache
+from editgen._server import EditServer
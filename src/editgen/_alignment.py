@@ -0,0 +1,102 @@
+from bisect import bisect_right
+from collections import defaultdict
+from functools import lru_cache
+from typing import Union
+
+import numpy as np
+
+
+class TokenAlignment(object):
+    def __init__(self, tokenizer, prompt: str) -> None:
+        self.prompt = prompt
+
+        self.is_fast = getattr(tokenizer, "is_fast", False)
+        if self.is_fast:
+            encoding = tokenizer(prompt, return_offsets_mapping=True)
+            self.offsets = list(encoding["offset_mapping"])
+        else:
+            encoding = tokenizer(prompt)
+            self.offsets = None
+
+        self.input_ids = list(encoding["input_ids"])
+        self.tokens = tokenizer.batch_decode([[item] for item in self.input_ids])
+
+        self._positions = defaultdict(list)
+        for index, token in enumerate(self.tokens):
+            self._positions[token].append(index)
+
+    def __len__(self) -> int:
+        return len(self.input_ids)
+
+    def get_word_indices(self, word_place: Union[int, str]) -> np.ndarray:
+        words = self.prompt.split(" ")
+        if isinstance(word_place, str):
+            word_place = {
+                index for index, word in enumerate(words) if word == word_place
+            }
+        else:
+            word_place = {word_place}
+
+        if not word_place:
+            return np.array([], dtype=np.int64)
+
+        word_ids = self._get_word_ids(words)
+
+        return np.array(
+            [index for index, word_id in enumerate(word_ids) if word_id in word_place],
+            dtype=np.int64,
+        )
+
+    def get_prefix_indices(self, word: str) -> list[int]:
+        # Every token that extends the prefix of `word` matched so far
+        indices, prefix = [], ""
+        for index, token in enumerate(self.tokens):
+            if word.startswith(prefix + token):
+                prefix += token
+                indices.append(index)
+
+        return indices
+
+    def get_matching_indices(self, other: "TokenAlignment") -> list[tuple[int, int]]:
+        indices = []
+        for i, token in enumerate(self.tokens):
+            if token.startswith("<"):
+                continue
+
+            indices.extend((i, j) for j in other._positions.get(token, []))
+
+        return indices
+
+    def _get_word_ids(self, words: list[str]) -> list[int]:
+        if self.offsets is not None:
+            starts = np.cumsum([0] + [len(word) + 1 for word in words[:-1]]).tolist()
+
+            word_ids = []
+            for start, end in self.offsets:
+                # Special tokens span no characters
+                if start == end:
+                    word_ids.append(-1)
+                    continue
+
+                while start < end - 1 and self.prompt[start] == " ":
+                    start += 1
+
+                word_ids.append(bisect_right(starts, start) - 1)
+
+            return word_ids
+
+        # Slow tokenizers: consume the words by the length of the decoded tokens
+        word_ids, length, ptr = [-1], 0, 0
+        for token in self.tokens[1:-1]:
+            word_ids.append(ptr)
+
+            length += len(token.strip("#"))
+            if ptr < len(words) and length >= len(words[ptr]):
+                ptr, length = ptr + 1, 0
+
+        return word_ids + [-1]
+
+
+@lru_cache(maxsize=4096)
+def get_alignment(tokenizer, prompt: str) -> TokenAlignment:
+    return TokenAlignment(tokenizer, prompt)
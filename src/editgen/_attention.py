@@ -9,161 +9,396 @@ from transformers.utils import (
 logger = logging.get_logger(__name__)
 
 
-def register_attention_control(model_proxy, controller):
-    def ca_forward(self, attention_type):
-        def forward(
-            hidden_states: torch.Tensor,
-            key_value_states: Optional[torch.Tensor] = None,
-            past_key_value: Optional[Tuple[torch.Tensor]] = None,
-            attention_mask: Optional[torch.Tensor] = None,
-            layer_head_mask: Optional[torch.Tensor] = None,
-            output_attentions: bool = False,
-        ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
-            """Input shape: Batch x Time x Channel"""
-            # if key_value_states are provided this layer is used as a cross-attention layer
-            # for the decoder
-            is_cross_attention = key_value_states is not None
-
-            bsz, tgt_len, _ = hidden_states.size()
-
-            # get query proj
-            query_states = self.q_proj(hidden_states) * self.scaling
-            # get key, value proj
-            # `past_key_value[0].shape[2] == key_value_states.shape[1]`
-            # is checking that the `sequence_length` of the `past_key_value` is the same as
-            # the provided `key_value_states` to support prefix tuning
-            if (
-                is_cross_attention
-                and past_key_value is not None
-                and past_key_value[0].shape[2] == key_value_states.shape[1]
-            ):
-                # reuse k,v, cross_attentions
-                key_states = past_key_value[0]
-                value_states = past_key_value[1]
-            elif is_cross_attention:
-                # cross_attentions
-                key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
-                value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
-            elif past_key_value is not None:
-                # reuse k, v, self_attention
-                key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
-                value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
-                key_states = torch.cat([past_key_value[0], key_states], dim=2)
-                value_states = torch.cat([past_key_value[1], value_states], dim=2)
-            else:
-                # self_attention
-                key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
-                value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
-
-            if self.is_decoder:
-                # if cross_attention save Tuple(torch.Tensor, torch.Tensor) of all cross attention key/value_states.
-                # Further calls to cross_attention layer can then reuse all cross-attention
-                # key/value_states (first "if" case)
-                # if uni-directional self-attention (decoder) save Tuple(torch.Tensor, torch.Tensor) of
-                # all previous decoder key/value_states. Further calls to uni-directional self-attention
-                # can concat previous decoder key/value_states to current projected key/value_states (third "elif" case)
-                # if encoder bi-directional self-attention `past_key_value` is always `None`
-                past_key_value = (key_states, value_states)
-
-            proj_shape = (bsz * self.num_heads, -1, self.head_dim)
-            query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
-            key_states = key_states.reshape(*proj_shape)
-            value_states = value_states.reshape(*proj_shape)
-
-            src_len = key_states.size(1)
-            attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
-
-            if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
-                raise ValueError(
-                    f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is"
-                    f" {attn_weights.size()}",
-                )
+class AttentionHooks(object):
+    def __init__(self) -> None:
+        self.controller = None
+        self.num_att_layers = 0
+        self.max_length = None
+        self.cross_states = {}
 
-            if attention_mask is not None:
-                if attention_mask.size() != (bsz, 1, tgt_len, src_len):
-                    raise ValueError(
-                        f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}",
-                    )
-                attn_weights = (
-                    attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-                    + attention_mask
-                )
-                attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
-
-            attn_weights = nn.functional.softmax(attn_weights, dim=-1)
-            attn_weights = controller(attn_weights, is_cross_attention, attention_type)
-
-            if layer_head_mask is not None:
-                if layer_head_mask.size() != (self.num_heads,):
-                    raise ValueError(
-                        f"Head mask for a single layer should be of size {(self.num_heads,)}, but is"
-                        f" {layer_head_mask.size()}",
-                    )
-                attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(
-                    bsz, self.num_heads, tgt_len, src_len
-                )
-                attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
-
-            if output_attentions:
-                # this operation is a bit awkward, but it's required to
-                # make sure that attn_weights keeps its gradient.
-                # In order to do so, attn_weights have to be reshaped
-                # twice and have to be reused in the following
-                attn_weights_reshaped = attn_weights.view(
-                    bsz, self.num_heads, tgt_len, src_len
-                )
-                attn_weights = attn_weights_reshaped.view(
-                    bsz * self.num_heads, tgt_len, src_len
-                )
+        self._forwards = {}
+        self._caches = {}
+
+    def step(self, is_cross, attention_type) -> bool:
+        if self.controller is None:
+            return False
+
+        self.controller.step()
+
+        # Cross-attention edits folded into the cached keys and values are done
+        if is_cross and self.controller.caches_cross_attention():
+            return False
+
+        return self.controller.requires_attention(is_cross, attention_type)
+
+    def edit(self, attn_weights, is_cross, attention_type):
+        return self.controller.edit(attn_weights, is_cross, attention_type)
+
+    def injects_self_attention(self) -> bool:
+        return self.controller.injects_self_attention()
+
+    def edit_cross_cache(self, key_states, value_states):
+        if self.controller is None or not self.controller.caches_cross_attention():
+            return key_states, value_states
+
+        return self.controller.edit_cross_cache(key_states, value_states)
+
+    def source_attention(self, src_len):
+        if self.controller.source is None:
+            return None
+
+        return self.controller.source.attention(self.controller.call_index, src_len)
+
+    def reserve(self, max_length: Optional[int]) -> None:
+        self.max_length = max_length
+
+    def update_cache(self, module, key_states, value_states, past_key_value):
+        past_length = 0 if past_key_value is None else past_key_value[0].shape[2]
+        length = past_length + key_states.shape[2]
+
+        cache = self._caches.get(module)
+        owned = (
+            cache is not None
+            and past_key_value is not None
+            and past_key_value[0].data_ptr() == cache[0].data_ptr()
+        )
+
+        if not owned and self.max_length is not None and length <= self.max_length:
+            if cache is None or not _fits(cache[0], key_states, self.max_length):
+                shape = (*key_states.shape[:2], self.max_length, key_states.shape[3])
+                cache = (key_states.new_empty(shape), value_states.new_empty(shape))
+                self._caches[module] = cache
+
+            # Adopt caches handed in from outside, such as a forked snapshot
+            if past_key_value is not None:
+                cache[0][:, :, :past_length] = past_key_value[0]
+                cache[1][:, :, :past_length] = past_key_value[1]
+
+            owned = True
+
+        # Fall back to growing the cache when it is not backed by our buffers
+        if not owned or length > cache[0].shape[2]:
+            if past_key_value is None:
+                return key_states, value_states
+
+            return (
+                torch.cat([past_key_value[0], key_states], dim=2),
+                torch.cat([past_key_value[1], value_states], dim=2),
+            )
+
+        cache[0][:, :, past_length:length] = key_states
+        cache[1][:, :, past_length:length] = value_states
+
+        # The decoder infers positions from the cache length, so hand out views of
+        # the filled prefix
+        return cache[0][:, :, :length], cache[1][:, :, :length]
+
+    def export_cache(self, length: int) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        # Buffers are created in decoder layer order on the first step
+        return [
+            (key[:, :, :length].clone(), value[:, :, :length].clone())
+            for key, value in self._caches.values()
+        ]
+
+    @property
+    def installed(self) -> bool:
+        return len(self._forwards) > 0
+
+    def install(self, model_proxy) -> None:
+        if self.installed:
+            self.uninstall()
+
+        for _, layer in model_proxy.decoder_layers.named_children():
+            if layer.__class__.__name__ != "MusicgenDecoderLayer":
+                continue
+
+            for name, module in layer.named_children():
+                attention_type = None
+                if name == "encoder_attn":
+                    attention_type = "cross"
+                elif name == "self_attn":
+                    attention_type = "self"
+
+                if attention_type is None:
+                    continue
+
+                if module.__class__.__name__ != "MusicgenAttention":
+                    continue
+
+                self._forwards[module] = module.__dict__.get("forward")
+                module.forward = _attention_forward(module, self, attention_type)
+
+        self.num_att_layers = len(self._forwards)
+
+    def uninstall(self) -> None:
+        for module, forward in self._forwards.items():
+            if forward is None:
+                del module.forward
             else:
-                attn_weights_reshaped = None
+                module.forward = forward
+
+        self._forwards = {}
+        self._caches = {}
+        self.num_att_layers = 0
+        self.controller = None
+        self.cross_states = {}
+
+
+def register_attention_control(model_proxy, controller) -> AttentionHooks:
+    hooks = AttentionHooks()
+    hooks.install(model_proxy)
+    hooks.controller = controller
+
+    controller.num_att_layers = hooks.num_att_layers
+
+    return hooks
+
+
+def _fits(buffer, key_states, max_length) -> bool:
+    return (
+        buffer.shape[:2] == key_states.shape[:2]
+        and buffer.shape[2] >= max_length
+        and buffer.shape[3] == key_states.shape[3]
+        and buffer.dtype == key_states.dtype
+        and buffer.device == key_states.device
+    )
+
+
+def _scaled_dot_product_attention(self, query, key, value, attention_mask):
+    dropout = self.dropout if self.training else 0.0
 
-            attn_probs = nn.functional.dropout(
-                attn_weights, p=self.dropout, training=self.training
+    # `self.scaling` matches the default `1 / sqrt(head_dim)` scale of the fused kernel
+    if hasattr(nn.functional, "scaled_dot_product_attention"):
+        return nn.functional.scaled_dot_product_attention(
+            query, key, value, attn_mask=attention_mask, dropout_p=dropout
+        )
+
+    attn_weights = torch.matmul(query * self.scaling, key.transpose(-1, -2))
+    if attention_mask is not None:
+        attn_weights = attn_weights + attention_mask
+
+    attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+    attn_weights = nn.functional.dropout(
+        attn_weights, p=dropout, training=self.training
+    )
+
+    return torch.matmul(attn_weights, value)
+
+
+def _injected_self_attention(self, query, key, value, attention_mask, attn_base=None):
+    # Every conditional row attends with the base prompt's weights, so only the base
+    # row and the unconditional half need their own query-key products
+    h1 = query.shape[0] // 2
+
+    if attn_base is not None:
+        # The base prompt is a replayed source outside of the batch
+        attn_weights = attn_base.unsqueeze(0)
+    else:
+        attn_weights = torch.matmul(query[:1] * self.scaling, key[:1].transpose(-1, -2))
+        if attention_mask is not None:
+            attn_weights = attn_weights + attention_mask[:1]
+
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+
+    attn_weights = nn.functional.dropout(
+        attn_weights, p=self.dropout, training=self.training
+    )
+
+    conditional = torch.matmul(attn_weights, value[:h1])
+    unconditional = _scaled_dot_product_attention(
+        self,
+        query[h1:],
+        key[h1:],
+        value[h1:],
+        attention_mask[h1:] if attention_mask is not None else None,
+    )
+
+    return torch.cat([conditional, unconditional])
+
+
+def _attention_forward(self, hooks, attention_type):
+    def forward(
+        hidden_states: torch.Tensor,
+        key_value_states: Optional[torch.Tensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        layer_head_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        """Input shape: Batch x Time x Channel"""
+        # if key_value_states are provided this layer is used as a cross-attention layer
+        # for the decoder
+        is_cross_attention = key_value_states is not None
+
+        bsz, tgt_len, _ = hidden_states.size()
+
+        # get query proj
+        query_states = self.q_proj(hidden_states)
+        # get key, value proj
+        # `past_key_value[0].shape[2] == key_value_states.shape[1]`
+        # is checking that the `sequence_length` of the `past_key_value` is the same as
+        # the provided `key_value_states` to support prefix tuning
+        if (
+            is_cross_attention
+            and past_key_value is not None
+            and past_key_value[0].shape[2] == key_value_states.shape[1]
+        ):
+            # reuse k,v, cross_attentions
+            key_states = past_key_value[0]
+            value_states = past_key_value[1]
+        elif is_cross_attention and self in hooks.cross_states:
+            # cross_attentions of cached prompts, only the unconditional rows are new
+            key_states, value_states = hooks.cross_states[self]
+            h1 = key_states.shape[0]
+
+            key_value_states = key_value_states[h1:]
+            key_states = torch.cat(
+                [key_states, self._shape(self.k_proj(key_value_states), -1, bsz - h1)]
+            )
+            value_states = torch.cat(
+                [value_states, self._shape(self.v_proj(key_value_states), -1, bsz - h1)]
+            )
+            key_states, value_states = hooks.edit_cross_cache(key_states, value_states)
+        elif is_cross_attention:
+            # cross_attentions
+            key_states = self._shape(self.k_proj(key_value_states), -1, bsz)
+            value_states = self._shape(self.v_proj(key_value_states), -1, bsz)
+            key_states, value_states = hooks.edit_cross_cache(key_states, value_states)
+        else:
+            # self_attention, written in place into the preallocated cache
+            key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
+            value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
+            key_states, value_states = hooks.update_cache(
+                self, key_states, value_states, past_key_value
             )
 
-            attn_output = torch.bmm(attn_probs, value_states)
+        if self.is_decoder:
+            # if cross_attention save Tuple(torch.Tensor, torch.Tensor) of all cross attention key/value_states.
+            # Further calls to cross_attention layer can then reuse all cross-attention
+            # key/value_states (first "if" case)
+            # if uni-directional self-attention (decoder) save Tuple(torch.Tensor, torch.Tensor) of
+            # all previous decoder key/value_states. Further calls to uni-directional self-attention
+            # can concat previous decoder key/value_states to current projected key/value_states (third "elif" case)
+            # if encoder bi-directional self-attention `past_key_value` is always `None`
+            past_key_value = (key_states, value_states)
 
-            if attn_output.size() != (bsz * self.num_heads, tgt_len, self.head_dim):
-                raise ValueError(
-                    f"`attn_output` should be of size {(bsz * self.num_heads, tgt_len, self.head_dim)}, but is"
-                    f" {attn_output.size()}",
-                )
+        # Slots the controller does not touch never need the attention weights
+        requires_attention = hooks.step(is_cross_attention, attention_type)
+        if not requires_attention and not output_attentions and layer_head_mask is None:
+            attn_output = _scaled_dot_product_attention(
+                self,
+                self._shape(query_states, tgt_len, bsz),
+                key_states,
+                value_states,
+                attention_mask,
+            )
 
-            attn_output = attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim)
             attn_output = attn_output.transpose(1, 2)
+            attn_output = attn_output.reshape(bsz, tgt_len, self.embed_dim)
+
+            attn_output = self.out_proj(attn_output)
 
-            # Use the `embed_dim` from the config (stored in the class) rather than `hidden_state` because `attn_output` can be
-            # partitioned across GPUs when using tensor-parallelism.
+            return attn_output, None, past_key_value
+
+        if (
+            not is_cross_attention
+            and hooks.injects_self_attention()
+            and not output_attentions
+            and layer_head_mask is None
+        ):
+            attn_output = _injected_self_attention(
+                self,
+                self._shape(query_states, tgt_len, bsz),
+                key_states,
+                value_states,
+                attention_mask,
+                hooks.source_attention(key_states.shape[2]),
+            )
+
+            attn_output = attn_output.transpose(1, 2)
             attn_output = attn_output.reshape(bsz, tgt_len, self.embed_dim)
 
             attn_output = self.out_proj(attn_output)
 
-            return attn_output, attn_weights_reshaped, past_key_value
+            return attn_output, None, past_key_value
+
+        query_states = query_states * self.scaling
+
+        proj_shape = (bsz * self.num_heads, -1, self.head_dim)
+        query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
+        key_states = key_states.reshape(*proj_shape)
+        value_states = value_states.reshape(*proj_shape)
 
-        return forward
+        src_len = key_states.size(1)
+        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+
+        if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
+            raise ValueError(
+                f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is"
+                f" {attn_weights.size()}",
+            )
+
+        if attention_mask is not None:
+            if attention_mask.size() != (bsz, 1, tgt_len, src_len):
+                raise ValueError(
+                    f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}",
+                )
+            attn_weights = (
+                attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+                + attention_mask
+            )
+            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
 
-    def register_recr(net_, count, attention_type):
-        if net_.__class__.__name__ == "MusicgenAttention":
-            net_.forward = ca_forward(net_, attention_type)
-            return count + 1
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+        if requires_attention:
+            attn_weights = hooks.edit(attn_weights, is_cross_attention, attention_type)
+
+        if layer_head_mask is not None:
+            if layer_head_mask.size() != (self.num_heads,):
+                raise ValueError(
+                    f"Head mask for a single layer should be of size {(self.num_heads,)}, but is"
+                    f" {layer_head_mask.size()}",
+                )
+            attn_weights = layer_head_mask.view(1, -1, 1, 1) * attn_weights.view(
+                bsz, self.num_heads, tgt_len, src_len
+            )
+            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+
+        if output_attentions:
+            # this operation is a bit awkward, but it's required to
+            # make sure that attn_weights keeps its gradient.
+            # In order to do so, attn_weights have to be reshaped
+            # twice and have to be reused in the following
+            attn_weights_reshaped = attn_weights.view(
+                bsz, self.num_heads, tgt_len, src_len
+            )
+            attn_weights = attn_weights_reshaped.view(
+                bsz * self.num_heads, tgt_len, src_len
+            )
+        else:
+            attn_weights_reshaped = None
+
+        attn_probs = nn.functional.dropout(
+            attn_weights, p=self.dropout, training=self.training
+        )
+
+        attn_output = torch.bmm(attn_probs, value_states)
+
+        if attn_output.size() != (bsz * self.num_heads, tgt_len, self.head_dim):
+            raise ValueError(
+                f"`attn_output` should be of size {(bsz * self.num_heads, tgt_len, self.head_dim)}, but is"
+                f" {attn_output.size()}",
+            )
 
-        return count
+        attn_output = attn_output.view(bsz, self.num_heads, tgt_len, self.head_dim)
+        attn_output = attn_output.transpose(1, 2)
 
-    cross_att_count = 0
-    sub_nets = model_proxy.decoder_layers.named_children()
-    for net in sub_nets:
-        if net[1].__class__.__name__ != "MusicgenDecoderLayer":
-            continue
+        # Use the `embed_dim` from the config (stored in the class) rather than `hidden_state` because `attn_output` can be
+        # partitioned across GPUs when using tensor-parallelism.
+        attn_output = attn_output.reshape(bsz, tgt_len, self.embed_dim)
 
-        for subnet in net[1].named_children():
-            attention_type = None
-            if subnet[0] == "encoder_attn":
-                attention_type = "cross"
-            elif subnet[0] == "self_attn":
-                attention_type = "self"
+        attn_output = self.out_proj(attn_output)
 
-            if attention_type is not None:
-                cross_att_count += register_recr(subnet[1], 0, attention_type)
+        return attn_output, attn_weights_reshaped, past_key_value
 
-    controller.num_att_layers = cross_att_count
+    return forward
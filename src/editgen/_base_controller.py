@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from collections import defaultdict
+from typing import Optional
 
 import torch
 
@@ -13,20 +14,65 @@ class BaseController(ABC):
         self.cur_att_layer = 0
         self.cur_step = 0
 
-    def __call__(self, attn_weights, is_cross, attention_type) -> None:
+        self.source = None
+
+    def prepare(self, batch_size, max_new_tokens, num_att_layers) -> None:
+        self.reset()
+
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.num_att_layers = num_att_layers
+
+    @property
+    def call_index(self) -> int:
+        return self.cur_step * self.num_att_layers + self.cur_att_layer - 1
+
+    def __call__(self, attn_weights, is_cross, attention_type):
+        self.step()
+
+        return self.edit(attn_weights, is_cross, attention_type)
+
+    def step(self) -> None:
         self.cur_att_layer = self.cur_att_layer + 1
         if self.cur_att_layer == self.num_att_layers:
             self.cur_att_layer = 0
             self.cur_step = self.cur_step + 1
 
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        return True
+
+    def injects_self_attention(self) -> bool:
+        return False
+
+    def caches_cross_attention(self) -> bool:
+        return False
+
+    def get_num_rows(self) -> Optional[int]:
+        return None
+
+    def edit_cross_cache(self, key_states, value_states):
+        return key_states, value_states
+
+    def edit(self, attn_weights, is_cross, attention_type):
         # Exclude unconditional inputs
         h1 = attn_weights.shape[0] // 2
-        attn = attn_weights[:h1]
+
+        attn_weights[:h1] = self.edit_rows(attn_weights[:h1], is_cross, attention_type)
+
+        return attn_weights
+
+    def edit_rows(self, attn, is_cross, attention_type):
+        # A replayed source is not part of the batch
+        num_rows = self.batch_size if self.source is None else self.batch_size - 1
 
         # Reshape according to batch size
-        h2 = attn.shape[0] // (self.batch_size)
+        h2 = attn.shape[0] // num_rows
 
-        attn = attn.reshape(self.batch_size, h2, *attn.shape[1:])
+        attn = attn.reshape(num_rows, h2, *attn.shape[1:])
+
+        if self.source is not None:
+            attn_base = self.source.attention(self.call_index, attn.shape[-1])
+            attn = torch.cat([attn_base.unsqueeze(0), attn])
 
         if is_cross:
             attn = self.replace_cross_attention(attn, is_cross, attention_type)
@@ -34,11 +80,12 @@ class BaseController(ABC):
         else:
             attn = self.replace_self_attention(attn)
 
-        attn = attn.reshape(self.batch_size * h2, *attn.shape[2:])
+        if self.source is not None:
+            attn = attn[1:]
 
-        attn_weights[:h1] = attn
+        attn = attn.reshape(num_rows * h2, *attn.shape[2:])
 
-        return attn_weights
+        return attn
 
     @abstractmethod
     def replace_self_attention(self, attn):
@@ -50,6 +97,9 @@ class BaseController(ABC):
 
 
 class EmptyController(BaseController):
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        return False
+
     def replace_self_attention(self, attn):
         return attn
 
@@ -57,26 +107,72 @@ class EmptyController(BaseController):
         return attn_weights
 
 
+class RoutingController(BaseController):
+    def __init__(
+        self, controllers: list[BaseController], batch_sizes: list[int]
+    ) -> None:
+        super().__init__()
+
+        self.controllers = controllers
+        self.batch_sizes = batch_sizes
+
+    def prepare(self, batch_size, max_new_tokens, num_att_layers) -> None:
+        super().prepare(batch_size, max_new_tokens, num_att_layers)
+
+        for controller, size in zip(self.controllers, self.batch_sizes):
+            controller.prepare(size, max_new_tokens, num_att_layers)
+
+    def step(self) -> None:
+        super().step()
+
+        for controller in self.controllers:
+            controller.step()
+
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        return any(
+            controller.requires_attention(is_cross, attention_type)
+            for controller in self.controllers
+        )
+
+    def edit_rows(self, attn, is_cross, attention_type):
+        h2 = attn.shape[0] // self.batch_size
+
+        # Each job owns a contiguous block of the batch
+        start = 0
+        for controller, size in zip(self.controllers, self.batch_sizes):
+            end = start + size * h2
+            if controller.requires_attention(is_cross, attention_type):
+                attn[start:end] = controller.edit_rows(
+                    attn[start:end], is_cross, attention_type
+                )
+            start = end
+
+        return attn
+
+    def replace_self_attention(self, attn):
+        raise NotImplementedError
+
+    def replace_cross_attention(self, attn_weights, is_cross, attention_type):
+        raise NotImplementedError
+
+
 class AttentionStore(BaseController):
+    def __init__(self, self_reduction=None) -> None:
+        super().__init__()
+
+        # Self-attention grows along the key axis with every cached decoding step
+        self.self_reduction = self_reduction or _mean_over_keys
+
     def reset(self):
         super().reset()
 
-        self.features = defaultdict(lambda: [])
+        self.features = {}
 
     def get_self_attention(self):
-        tensors = self.features["self"]
-        tensors = [tensor.mean(dim=-1) for tensor in tensors]
-        tensors = torch.stack(tensors)
-        tensors = tensors.view(self.max_new_tokens, -1, *tensors.shape[1:])
-
-        return tensors
+        return self.features["self"]
 
     def get_cross_attention(self):
-        tensors = self.features["cross"]
-        tensors = torch.stack(tensors)
-        tensors = tensors.view(self.max_new_tokens, -1, *tensors[0].shape)
-
-        return tensors
+        return self.features["cross"]
 
     def get_self_attention_importance(self):
         aggregate_cross_attention = self.get_self_attention()
@@ -125,14 +221,91 @@ class AttentionStore(BaseController):
         return sorted_indices
 
     def get_aggregate_cross_attention(self):
-        return torch.mean(torch.stack(self.features["cross"]), axis=0)
+        return self.get_cross_attention().mean(dim=(0, 1))
+
+    def replace_self_attention(self, attn) -> None:
+        self._store("self", self.self_reduction(attn))
+
+        return attn
+
+    def replace_cross_attention(self, attn_weights, is_cross, attention_type) -> None:
+        self._store("cross", attn_weights)
+
+        return attn_weights
+
+    def _store(self, key, attn) -> None:
+        # Self and cross-attention layers alternate, starting with self-attention
+        step, layer = divmod(self.call_index, self.num_att_layers)
+        layer //= 2
+
+        if key not in self.features:
+            self.features[key] = attn.new_zeros(
+                self.max_new_tokens, self.num_att_layers // 2, *attn.shape
+            )
+
+        self.features[key][step, layer] = attn
+
+
+class StreamingAttentionStore(AttentionStore):
+    def __init__(self, self_reduction=None, offload: bool = False) -> None:
+        super().__init__(self_reduction)
+
+        self.offload = offload
+
+    def reset(self):
+        super().reset()
+
+        self.sums = {}
+        self.counts = defaultdict(int)
+
+    def get_self_attention(self):
+        return self._get_mean("self").unsqueeze(0)
+
+    def get_cross_attention(self):
+        return self._get_mean("cross").unsqueeze(0)
+
+    def get_aggregate_cross_attention(self):
+        return self._get_mean("cross").mean(dim=0)
 
     def replace_self_attention(self, attn) -> None:
-        self.features["self"].append(attn)
+        self._accumulate("self", self.self_reduction(attn))
 
         return attn
 
     def replace_cross_attention(self, attn_weights, is_cross, attention_type) -> None:
-        self.features["cross"].append(attn_weights)
+        self._accumulate("cross", attn_weights)
 
         return attn_weights
+
+    def _accumulate(self, key, attn) -> None:
+        # Self and cross-attention layers alternate, starting with self-attention
+        layer = (self.call_index % self.num_att_layers) // 2
+
+        if key not in self.sums:
+            self.sums[key] = attn.new_zeros(self.num_att_layers // 2, *attn.shape)
+
+        self.sums[key][layer] += attn
+        self.counts[key] += 1
+
+        # Release device memory as soon as the last call has been folded in. The
+        # counters have already stepped past it by now, so `step` is too early
+        last_call_index = self.max_new_tokens * self.num_att_layers - 1
+        if self.offload and self.call_index == last_call_index:
+            self.sums = {key: _to_host(tensor) for key, tensor in self.sums.items()}
+
+    def _get_mean(self, key):
+        num_steps = self.counts[key] // (self.num_att_layers // 2)
+
+        return self.sums[key] / num_steps
+
+
+def _mean_over_keys(attn):
+    return attn.mean(dim=-1)
+
+
+def _to_host(tensor):
+    tensor = tensor.cpu()
+    if torch.cuda.is_available():
+        tensor = tensor.pin_memory()
+
+    return tensor
@@ -1,12 +1,31 @@
-from typing import Any
+from threading import Thread
+from typing import Any, Iterator, Optional, Union
 
 import numpy as np
 import torch
 from numpy.typing import NDArray
-from transformers import AutoProcessor, MusicgenForConditionalGeneration
+from transformers import (
+    AutoProcessor,
+    BatchEncoding,
+    MusicgenForConditionalGeneration,
+)
+from transformers.generation.streamers import BaseStreamer
 
-from editgen._base_controller import EmptyController, BaseController
-from editgen._attention import register_attention_control
+from editgen._base_controller import (
+    BaseController,
+    EmptyController,
+    RoutingController,
+)
+from editgen._attention import AttentionHooks
+from editgen._prompt_cache import PromptCache, PromptEncoding
+from editgen._snapshot import (
+    DecodeSnapshot,
+    SnapshotReached,
+    TokenRecorder,
+    get_prompt_ids,
+)
+from editgen._source import SourceRecord, SourceRecorder
+from editgen._streaming import AudioStreamer
 
 
 class ModelProxy(object):
@@ -22,7 +41,11 @@ class ModelProxy(object):
         )
 
     def generate(
-        self, inputs: dict[str, Any], max_new_tokens: int = 512
+        self,
+        inputs: dict[str, Any],
+        max_new_tokens: int = 512,
+        streamer: Optional[BaseStreamer] = None,
+        **kwargs,
     ) -> NDArray[np.float_]:
         return (
             self.model.generate(
@@ -30,6 +53,8 @@ class ModelProxy(object):
                 do_sample=True,
                 guidance_scale=self.guidance_scale,
                 max_new_tokens=max_new_tokens,
+                streamer=streamer,
+                **kwargs,
             )
             .cpu()
             .numpy()
@@ -62,32 +87,387 @@ class EditGenPipeline(ModelProxy):
         guidance_scale: float = 3.0,
         seed: int = 0,
         audio_length: float = 10.0,
+        prompt_cache: Optional[PromptCache] = None,
     ):
         super().__init__(model_name, guidance_scale)
 
         self._seed = seed
         self._audio_length = audio_length
+        self._prompt_cache = prompt_cache
+
+        self._hooks = AttentionHooks()
+        self._hooks.install(self)
+
+    @property
+    def audio_length(self) -> float:
+        return self._audio_length
+
+    def uninstall(self) -> None:
+        self._hooks.uninstall()
+
+    @property
+    def max_new_tokens(self) -> int:
+        return self.get_max_new_tokens(self.audio_length)
+
+    def get_max_new_tokens(self, audio_length: float) -> int:
+        return 2 ** round(np.log2(audio_length * self.frame_rate))
 
     def __call__(
         self,
         controller: BaseController,
         *prompts: list[str],
+        source: Optional[SourceRecord] = None,
     ) -> NDArray[np.float_]:
-        max_new_tokens = 2 ** round(np.log2(self.audio_length * self.frame_rate))
+        if controller is None:
+            controller = EmptyController()
 
-        if self._seed is not None:
-            torch.manual_seed(self._seed)
+        if source is None:
+            return self._generate(controller, list(prompts))
+
+        self._check_source(source, prompts)
+
+        audio_values = self._generate(controller, list(prompts), source=source)
+
+        return np.vstack([source.audio_values, audio_values])
+
+    def sweep(
+        self,
+        controller: BaseController,
+        source: Union[str, SourceRecord],
+        prompt: str,
+        num_edits: int,
+    ) -> NDArray[np.float_]:
+        # The controller holds one parameter per edited row
+        num_rows = controller.get_num_rows() if controller is not None else None
+        if num_rows is not None and num_rows != num_edits:
+            raise ValueError(
+                f"Expected one parameter per edited row ({num_edits}), got {num_rows}"
+            )
+
+        prompts = [prompt] * num_edits
+
+        if isinstance(source, SourceRecord):
+            return self(controller, source.prompt, *prompts, source=source)
+
+        return self(controller, source, *prompts)
+
+    def batch(
+        self,
+        *jobs: tuple[BaseController, list[str]],
+        audio_length: Optional[float] = None,
+    ) -> list[NDArray[np.float_]]:
+        controllers, batch_sizes, prompts = [], [], []
+        for controller, job_prompts in jobs:
+            controllers.append(
+                controller if controller is not None else EmptyController()
+            )
+            batch_sizes.append(len(job_prompts))
+            prompts.extend(job_prompts)
+
+        controller = RoutingController(controllers, batch_sizes)
+
+        max_new_tokens = None
+        if audio_length is not None:
+            max_new_tokens = self.get_max_new_tokens(audio_length)
+
+        audio_values = self._generate(
+            controller, prompts, max_new_tokens=max_new_tokens
+        )
+        audio_values = audio_values.reshape(len(prompts), -1)
+
+        return np.split(audio_values, np.cumsum(batch_sizes)[:-1])
+
+    def stream(
+        self,
+        controller: BaseController,
+        *prompts: list[str],
+        source: Optional[SourceRecord] = None,
+        play_steps: int = 50,
+    ) -> Iterator[NDArray[np.float_]]:
+        if controller is None:
+            controller = EmptyController()
+
+        if source is not None:
+            self._check_source(source, prompts)
+
+        streamer = AudioStreamer(self, play_steps=play_steps)
+
+        errors = []
+
+        def target():
+            try:
+                self._generate(controller, list(prompts), source, streamer)
+            except BaseException as error:
+                errors.append(error)
+                streamer.audio_queue.put(None)
+
+        thread = Thread(target=target)
+        thread.start()
+
+        offset = 0
+        for chunk in streamer:
+            if source is not None:
+                source_chunk = source.audio_values[offset : offset + chunk.shape[-1]]
+                chunk = np.vstack([source_chunk, chunk])
+
+            offset += chunk.shape[-1]
+
+            yield chunk
+
+        thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def snapshot(
+        self,
+        controller: BaseController,
+        *prompts: list[str],
+        step: int,
+        source: Optional[SourceRecord] = None,
+    ) -> DecodeSnapshot:
+        if controller is None:
+            controller = EmptyController()
+
+        # Every codebook needs a decoded token to resume from, and the resumed prompt
+        # must still fit its delay pattern
+        decoder = self.model.decoder
+        num_codebooks = decoder.num_codebooks
+        if decoder.config.audio_channels == 2:
+            num_codebooks //= 2
+
+        min_step = max(1, num_codebooks - 1)
+        max_step = min(self.max_new_tokens - 1, self.max_new_tokens - num_codebooks + 1)
+        if not min_step <= step <= max_step:
+            raise ValueError(f"Expected a step in [{min_step}, {max_step}], got {step}")
+
+        if source is not None:
+            self._check_source(source, prompts)
+
+        recorder = TokenRecorder(step + 1)
+        try:
+            self._generate(controller, list(prompts), source, recorder)
+        except SnapshotReached:
+            pass
 
+        cuda_rng_state = None
+        if torch.cuda.is_available():
+            cuda_rng_state = torch.cuda.get_rng_state_all()
+
+        return DecodeSnapshot(
+            list(prompts),
+            source,
+            self.max_new_tokens,
+            step,
+            get_prompt_ids(
+                self.model, recorder.token_cache, self.max_new_tokens + 1
+            ).to(self.device),
+            self._hooks.export_cache(step),
+            torch.get_rng_state(),
+            cuda_rng_state,
+            (controller.cur_step, controller.cur_att_layer),
+        )
+
+    def fork(
+        self, snapshot: DecodeSnapshot, controller: BaseController
+    ) -> NDArray[np.float_]:
         if controller is None:
             controller = EmptyController()
 
-        controller.reset()
-        controller.batch_size = len(prompts)
-        controller.max_new_tokens = max_new_tokens
+        if snapshot.max_new_tokens != self.max_new_tokens:
+            raise ValueError(
+                f"Snapshot was taken for {snapshot.max_new_tokens} tokens, "
+                f"not {self.max_new_tokens}"
+            )
+
+        audio_values = self._generate(
+            controller, snapshot.prompts, snapshot.source, snapshot=snapshot
+        )
+
+        if snapshot.source is None:
+            return audio_values
+
+        return np.vstack([snapshot.source.audio_values, audio_values])
+
+    def record(self, prompt: str) -> SourceRecord:
+        recorder = SourceRecorder()
+        audio_values = self._generate(recorder, [prompt])
+
+        return SourceRecord(
+            prompt, audio_values, recorder.attention, self.max_new_tokens
+        )
+
+    def _check_source(self, source: SourceRecord, prompts: list[str]) -> None:
+        if prompts[0] != source.prompt:
+            raise ValueError(
+                f"Expected source prompt '{source.prompt}', got '{prompts[0]}'"
+            )
+
+        if source.max_new_tokens != self.max_new_tokens:
+            raise ValueError(
+                f"Source was recorded for {source.max_new_tokens} tokens, "
+                f"not {self.max_new_tokens}"
+            )
+
+    def _generate(
+        self,
+        controller: BaseController,
+        prompts: list[str],
+        source: Optional[SourceRecord] = None,
+        streamer: Optional[BaseStreamer] = None,
+        max_new_tokens: Optional[int] = None,
+        snapshot: Optional[DecodeSnapshot] = None,
+    ) -> NDArray[np.float_]:
+        if max_new_tokens is None:
+            max_new_tokens = self.max_new_tokens
+
+        if snapshot is not None:
+            snapshot.restore_rng_state()
+        elif self._seed is not None:
+            torch.manual_seed(self._seed)
+
+        if not self._hooks.installed:
+            self._hooks.install(self)
+
+        # The decoder never attends over the last sampled token
+        self._hooks.reserve(max_new_tokens)
+
+        controller.prepare(len(prompts), max_new_tokens, self._hooks.num_att_layers)
+        controller.source = source
 
-        register_attention_control(self, controller)
+        num_steps, kwargs = max_new_tokens, {}
+        if snapshot is not None:
+            # Resume right after the last step the snapshot decoded
+            controller.cur_step, controller.cur_att_layer = snapshot.counters
+            num_steps -= snapshot.step
+            kwargs = snapshot.generate_kwargs()
+
+        # Encode the source alongside the edits so that every prompt shares its padding
+        start = 1 if source is not None else 0
+        if self._prompt_cache is None:
+            inputs = self.encode(prompts)
+            inputs = BatchEncoding(
+                {key: value[start:] for key, value in inputs.items()}
+            )
+        else:
+            inputs, kwargs["encoder_outputs"], cross_states = self._encode_cached(
+                prompts, start
+            )
+            self._hooks.cross_states = cross_states
 
-        inputs = self.encode(prompts)
-        audio_values = self.generate(inputs, max_new_tokens=max_new_tokens)
+        self._hooks.controller = controller
+        try:
+            audio_values = self.generate(
+                inputs, max_new_tokens=num_steps, streamer=streamer, **kwargs
+            )
+        finally:
+            self._hooks.controller = None
+            self._hooks.cross_states = {}
 
         return audio_values
+
+    def _encode_cached(
+        self, prompts: list[str], start: int
+    ) -> tuple[BatchEncoding, tuple[torch.Tensor], dict[torch.nn.Module, Any]]:
+        encodings = self._get_prompt_encodings(prompts)
+        length = max(len(encoding.input_ids) for encoding in encodings)
+        encodings = encodings[start:]
+
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        input_ids = torch.stack(
+            [
+                _pad(encoding.input_ids, length, 0, pad_token_id)
+                for encoding in encodings
+            ]
+        )
+        attention_mask = torch.stack(
+            [
+                _pad(torch.ones_like(encoding.input_ids), length, 0)
+                for encoding in encodings
+            ]
+        )
+        hidden_states = torch.stack(
+            [_pad(encoding.hidden_states, length, 0) for encoding in encodings]
+        )
+
+        # `generate` only adds the unconditional inputs when it runs the text encoder
+        attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)])
+        hidden_states = torch.cat([hidden_states, torch.zeros_like(hidden_states)])
+
+        cross_states = {}
+        for index, layer in enumerate(self.decoder_layers):
+            cross_states[layer.encoder_attn] = tuple(
+                torch.stack(
+                    [
+                        _pad(getattr(encoding, name)[index], length, 1)
+                        for encoding in encodings
+                    ]
+                )
+                for name in ("keys", "values")
+            )
+
+        inputs = BatchEncoding(
+            {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+
+        return inputs, (hidden_states,), cross_states
+
+    def _get_prompt_encodings(self, prompts: list[str]) -> list[PromptEncoding]:
+        encodings = {
+            prompt: self._prompt_cache.get(self.model_name, prompt)
+            for prompt in prompts
+        }
+
+        missing = [prompt for prompt, encoding in encodings.items() if encoding is None]
+        if missing:
+            for prompt, encoding in zip(missing, self._encode_prompts(missing)):
+                self._prompt_cache.put(self.model_name, prompt, encoding)
+                encodings[prompt] = encoding
+
+        return [encodings[prompt] for prompt in prompts]
+
+    @torch.no_grad()
+    def _encode_prompts(self, prompts: list[str]) -> list[PromptEncoding]:
+        inputs = self.encode(prompts).to(self.device)
+        attention_mask = inputs["attention_mask"]
+
+        hidden_states = self.model.text_encoder(**inputs).last_hidden_state
+
+        # The same projection the decoder applies to the encoder outputs
+        encoder_hidden_states = hidden_states
+        if hasattr(self.model, "enc_to_dec_proj"):
+            encoder_hidden_states = self.model.enc_to_dec_proj(encoder_hidden_states)
+        encoder_hidden_states = encoder_hidden_states * attention_mask[..., None]
+
+        keys, values = [], []
+        for layer in self.decoder_layers:
+            attn = layer.encoder_attn
+            keys.append(
+                attn._shape(attn.k_proj(encoder_hidden_states), -1, len(prompts))
+            )
+            values.append(
+                attn._shape(attn.v_proj(encoder_hidden_states), -1, len(prompts))
+            )
+
+        encodings = []
+        for index, length in enumerate(attention_mask.sum(dim=-1).tolist()):
+            encodings.append(
+                PromptEncoding(
+                    inputs["input_ids"][index, :length].clone(),
+                    hidden_states[index, :length].clone(),
+                    [key[index, :, :length].clone() for key in keys],
+                    [value[index, :, :length].clone() for value in values],
+                )
+            )
+
+        return encodings
+
+
+def _pad(tensor: torch.Tensor, length: int, dim: int, value=0) -> torch.Tensor:
+    shape = list(tensor.shape)
+    shape[dim] = length
+
+    padded = tensor.new_full(shape, value)
+    padded.narrow(dim, 0, tensor.shape[dim]).copy_(tensor)
+
+    return padded
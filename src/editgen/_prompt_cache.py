@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+import torch
+
+
+class PromptEncoding(object):
+    def __init__(
+        self,
+        input_ids: torch.Tensor,
+        hidden_states: torch.Tensor,
+        keys: list[torch.Tensor],
+        values: list[torch.Tensor],
+    ) -> None:
+        self.input_ids = input_ids
+        self.hidden_states = hidden_states
+        self.keys = keys
+        self.values = values
+
+    @property
+    def num_bytes(self) -> int:
+        tensors = [self.input_ids, self.hidden_states, *self.keys, *self.values]
+
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class PromptCache(object):
+    def __init__(self, max_bytes: int = 2**30) -> None:
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return key in self._entries
+
+    def get(self, model_name: str, prompt: str) -> Optional[PromptEncoding]:
+        key = (model_name, prompt)
+
+        with self._lock:
+            encoding = self._entries.get(key)
+            if encoding is not None:
+                self._entries.move_to_end(key)
+
+        return encoding
+
+    def put(self, model_name: str, prompt: str, encoding: PromptEncoding) -> None:
+        key = (model_name, prompt)
+
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key).num_bytes
+
+            if encoding.num_bytes > self.max_bytes:
+                return
+
+            self._entries[key] = encoding
+            self.num_bytes += encoding.num_bytes
+
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= evicted.num_bytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
@@ -0,0 +1,183 @@
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import monotonic
+from typing import Optional
+
+from editgen._base_controller import BaseController
+from editgen._model import EditGenPipeline
+
+
+class EditRequest(object):
+    def __init__(
+        self,
+        controller: BaseController,
+        prompts: list[str],
+        audio_length: float,
+        max_new_tokens: int,
+    ) -> None:
+        self.controller = controller
+        self.prompts = prompts
+        self.audio_length = audio_length
+        self.max_new_tokens = max_new_tokens
+
+        self.future = Future()
+
+
+class EditServer(object):
+    def __init__(
+        self,
+        pipeline: EditGenPipeline,
+        max_batch_size: int = 8,
+        max_wait: float = 0.05,
+    ) -> None:
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = Queue()
+        self._pending = []
+        self._thread = None
+        self._stopping = False
+        self._lock = Lock()
+
+    def __enter__(self) -> "EditServer":
+        self.start()
+
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._stopping = False
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        # Nothing can be submitted behind the sentinel once the thread is unset
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+
+            self._queue.put(None)
+
+        thread.join()
+
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except Empty:
+                break
+
+            if request is not None:
+                request.future.cancel()
+
+    def submit(
+        self,
+        controller: BaseController,
+        *prompts: list[str],
+        audio_length: Optional[float] = None,
+    ) -> Future:
+        if audio_length is None:
+            audio_length = self.pipeline.audio_length
+
+        request = EditRequest(
+            controller,
+            list(prompts),
+            audio_length,
+            self.pipeline.get_max_new_tokens(audio_length),
+        )
+        with self._lock:
+            if self._thread is None:
+                raise RuntimeError("The server is not running")
+
+            self._queue.put(request)
+
+        return request.future
+
+    def _run(self) -> None:
+        while not self._stopping or self._pending:
+            self._admit()
+
+            batch = self._schedule()
+            if batch:
+                self._execute(batch)
+
+    def _admit(self) -> None:
+        # Block only while idle. Requests left over from the last batch are only
+        # topped up with whatever already arrived, and a new one waits for others
+        # at most `max_wait` in total or until the batch is full
+        deadline = monotonic() if self._pending else None
+        while not self._stopping:
+            if deadline is None:
+                timeout = None
+            elif self._num_pending_rows() >= self.max_batch_size:
+                return
+            else:
+                timeout = max(0.0, deadline - monotonic())
+
+            try:
+                request = self._queue.get(timeout=timeout)
+            except Empty:
+                return
+
+            if request is None:
+                self._stopping = True
+                return
+
+            self._pending.append(request)
+            if deadline is None:
+                deadline = monotonic() + self.max_wait
+
+    def _num_pending_rows(self) -> int:
+        return sum(len(request.prompts) for request in self._pending)
+
+    def _schedule(self) -> list[EditRequest]:
+        if not self._pending:
+            return []
+
+        # Serve the oldest request, filling the batch with requests of the same length
+        # so that no request waits on the decoding steps of a longer one
+        max_new_tokens = self._pending[0].max_new_tokens
+
+        batch, num_rows = [], 0
+        for request in self._pending:
+            if request.max_new_tokens != max_new_tokens:
+                continue
+
+            if batch and num_rows + len(request.prompts) > self.max_batch_size:
+                continue
+
+            batch.append(request)
+            num_rows += len(request.prompts)
+
+        self._pending = [request for request in self._pending if request not in batch]
+
+        return batch
+
+    def _execute(self, batch: list[EditRequest]) -> None:
+        batch = [
+            request
+            for request in batch
+            if request.future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            return
+
+        try:
+            audio_values = self.pipeline.batch(
+                *[(request.controller, request.prompts) for request in batch],
+                audio_length=batch[0].audio_length,
+            )
+        except Exception as error:
+            for request in batch:
+                request.future.set_exception(error)
+        else:
+            for request, values in zip(batch, audio_values):
+                request.future.set_result(values)
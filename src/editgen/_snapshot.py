@@ -0,0 +1,99 @@
+from typing import Any, Optional
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from editgen._source import SourceRecord
+
+
+class DecodeSnapshot(object):
+    def __init__(
+        self,
+        prompts: list[str],
+        source: Optional[SourceRecord],
+        max_new_tokens: int,
+        step: int,
+        decoder_input_ids: torch.Tensor,
+        past_key_values: list[tuple[torch.Tensor, torch.Tensor]],
+        rng_state: torch.Tensor,
+        cuda_rng_state: Optional[list[torch.Tensor]],
+        counters: tuple[int, int],
+    ) -> None:
+        self.prompts = prompts
+        self.source = source
+        self.max_new_tokens = max_new_tokens
+        self.step = step
+
+        self.decoder_input_ids = decoder_input_ids
+        self.past_key_values = past_key_values
+
+        self.rng_state = rng_state
+        self.cuda_rng_state = cuda_rng_state
+
+        self.counters = counters
+
+    def restore_rng_state(self) -> None:
+        torch.set_rng_state(self.rng_state)
+        if self.cuda_rng_state is not None:
+            torch.cuda.set_rng_state_all(self.cuda_rng_state)
+
+    def generate_kwargs(self) -> dict[str, Any]:
+        # Empty cross-attention entries make every layer project the encoder states
+        # again, so that the forked controller can edit them
+        past_key_values = tuple(
+            (key, value, key[:, :, :0], value[:, :, :0])
+            for key, value in self.past_key_values
+        )
+
+        return {
+            "decoder_input_ids": self.decoder_input_ids,
+            "past_key_values": past_key_values,
+        }
+
+
+class SnapshotReached(Exception):
+    pass
+
+
+class TokenRecorder(BaseStreamer):
+    def __init__(self, num_tokens: int) -> None:
+        self.num_tokens = num_tokens
+        self.token_cache = None
+
+    def put(self, value: torch.Tensor) -> None:
+        if self.token_cache is None:
+            self.token_cache = value
+        else:
+            self.token_cache = torch.cat([self.token_cache, value[:, None]], dim=-1)
+
+        # Stopping `generate` any other way would change the delay pattern it samples
+        # with and decode a partial sequence
+        if self.token_cache.shape[-1] == self.num_tokens:
+            raise SnapshotReached()
+
+    def end(self) -> None:
+        pass
+
+
+def get_prompt_ids(model, token_cache: torch.Tensor, max_length: int) -> torch.Tensor:
+    decoder = model.decoder
+
+    _, delay_pattern_mask = decoder.build_delay_pattern_mask(
+        token_cache[:, :1],
+        pad_token_id=model.generation_config.decoder_start_token_id,
+        max_length=max_length,
+    )
+    input_ids = decoder.apply_delay_pattern_mask(token_cache, delay_pattern_mask)
+
+    num_codebooks = decoder.num_codebooks
+    seq_len = input_ids.shape[-1]
+    input_ids = input_ids.reshape(-1, num_codebooks, seq_len)
+
+    # `generate` delays every codebook of a prompt again, so undo the delay and leave
+    # the positions that were not decoded yet at -1 for them to still be sampled
+    prompt_ids = torch.full_like(input_ids, -1)
+    for codebook in range(num_codebooks):
+        delay = codebook if decoder.config.audio_channels == 1 else codebook // 2
+        prompt_ids[:, codebook, : seq_len - delay] = input_ids[:, codebook, delay:]
+
+    return prompt_ids.reshape(-1, seq_len)
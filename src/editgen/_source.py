@@ -0,0 +1,46 @@
+import numpy as np
+import torch
+from numpy.typing import NDArray
+
+from editgen._base_controller import BaseController
+
+
+class SourceRecord(object):
+    def __init__(
+        self,
+        prompt: str,
+        audio_values: NDArray[np.float_],
+        attention: list[torch.Tensor],
+        max_new_tokens: int,
+    ) -> None:
+        self.prompt = prompt
+        self.audio_values = audio_values
+        self.max_new_tokens = max_new_tokens
+
+        self._attention = attention
+
+    def attention(self, call_index: int, src_len: int) -> torch.Tensor:
+        attn = self._attention[call_index]
+
+        # The edited prompts may be padded further than the source was on its own
+        if attn.shape[-1] < src_len:
+            attn = torch.nn.functional.pad(attn, (0, src_len - attn.shape[-1]))
+
+        return attn
+
+
+class SourceRecorder(BaseController):
+    def reset(self):
+        super().reset()
+
+        self.attention = []
+
+    def replace_self_attention(self, attn):
+        self.attention.append(attn[0].clone())
+
+        return attn
+
+    def replace_cross_attention(self, attn_weights, is_cross, attention_type):
+        self.attention.append(attn_weights[0].clone())
+
+        return attn_weights
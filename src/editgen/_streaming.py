@@ -0,0 +1,110 @@
+from queue import Queue
+from typing import Optional
+
+import numpy as np
+import torch
+from numpy.typing import NDArray
+from transformers.generation.streamers import BaseStreamer
+
+
+class AudioStreamer(BaseStreamer):
+    def __init__(
+        self,
+        model_proxy,
+        play_steps: int = 50,
+        overlap: Optional[int] = None,
+        stride: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.model = model_proxy.model
+        self.play_steps = play_steps
+        self.timeout = timeout
+
+        self.num_codebooks = self.model.decoder.num_codebooks
+        self.hop_length = int(
+            np.prod(self.model.audio_encoder.config.upsampling_ratios)
+        )
+
+        # Frames of left context re-decoded in front of every window
+        self.overlap = overlap if overlap is not None else play_steps
+        # Trailing samples held back until the frames after them are known
+        if stride is None:
+            stride = self.hop_length * (play_steps - self.num_codebooks) // 6
+        self.stride = max(stride, 0)
+
+        self.token_cache = None
+        self.to_yield = 0
+
+        self.audio_queue = Queue()
+
+    def put(self, value: torch.Tensor) -> None:
+        if self.token_cache is None:
+            self.token_cache = value
+        else:
+            self.token_cache = torch.cat([self.token_cache, value[:, None]], dim=-1)
+
+        if self.token_cache.shape[-1] % self.play_steps == 0:
+            self._emit(self.stride)
+
+    def end(self) -> None:
+        if self.token_cache is not None:
+            self._emit(0)
+
+        self.audio_queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> NDArray[np.float_]:
+        value = self.audio_queue.get(timeout=self.timeout)
+        if value is None:
+            raise StopIteration
+
+        return value
+
+    def _emit(self, stride: int) -> None:
+        codes = self._codes()
+
+        num_frames = codes.shape[-1]
+        start_frame = max(0, self.to_yield // self.hop_length - self.overlap)
+
+        end = num_frames * self.hop_length - stride
+        if end <= self.to_yield:
+            return
+
+        audio_values = self._decode(codes[..., start_frame:])
+
+        offset = start_frame * self.hop_length
+        chunk = audio_values[:, self.to_yield - offset : end - offset]
+
+        self.to_yield += chunk.shape[-1]
+        self.audio_queue.put(chunk)
+
+    def _codes(self) -> torch.Tensor:
+        decoder = self.model.decoder
+        pad_token_id = self.model.generation_config.pad_token_id
+
+        input_ids = self.token_cache
+        _, delay_pattern_mask = decoder.build_delay_pattern_mask(
+            input_ids[:, :1],
+            pad_token_id=self.model.generation_config.decoder_start_token_id,
+            max_length=input_ids.shape[-1],
+        )
+        input_ids = decoder.apply_delay_pattern_mask(input_ids, delay_pattern_mask)
+
+        batch_size = input_ids.shape[0] // self.num_codebooks
+        input_ids = input_ids[input_ids != pad_token_id].reshape(
+            batch_size, self.num_codebooks, -1
+        )
+
+        return input_ids
+
+    def _decode(self, codes: torch.Tensor) -> NDArray[np.float_]:
+        audio_encoder = self.model.audio_encoder
+
+        codes = codes[None, ...].to(audio_encoder.device)
+        audio_values = audio_encoder.decode(
+            codes, audio_scales=[None] * codes.shape[1]
+        ).audio_values
+
+        return audio_values[:, 0].cpu().float().numpy()
@@ -1,34 +1,36 @@
+from editgen._alignment import TokenAlignment, get_alignment
 from editgen._model import ModelProxy
 
 
+def get_alignments(model: ModelProxy, prompts: list[str]) -> list[TokenAlignment]:
+    return [get_alignment(model.processor.tokenizer, prompt) for prompt in prompts]
+
+
 def get_tokens(model: ModelProxy, prompts: list[str]):
-    inputs = model.encode(prompts)
+    alignments = get_alignments(model, prompts)
 
-    tokens = []
-    for index in range(len(prompts)):
-        tokens.append([model.decode(item) for item in inputs["input_ids"][index]])
+    # Pad like a batched encoding would
+    tokenizer = model.processor.tokenizer
+    length = max(len(alignment) for alignment in alignments)
 
-    return tokens
+    return [
+        alignment.tokens + [tokenizer.pad_token] * (length - len(alignment))
+        for alignment in alignments
+    ]
 
 
 def get_replacement_indices(
     model: ModelProxy, prompts: list[str], word_a: str, word_b: str
 ) -> list[list[int]]:
-    token_groups = get_tokens(model, prompts)
-
     if len(prompts[0].split()) != len(prompts[1].split()):
         raise NotImplementedError(f"Different prompt lengths ({prompts})")
 
-    indices = []
-    for word, tokens in zip([word_a, word_b], token_groups):
-        prompt_indices, substring = [], []
-        for i in range(len(tokens)):
-            if word.startswith("".join([*substring, tokens[i]])):
-                substring.append(tokens[i])
-                prompt_indices.append(i)
-        indices.append(prompt_indices)
+    alignments = get_alignments(model, prompts)
 
-    return indices
+    return [
+        alignment.get_prefix_indices(word)
+        for word, alignment in zip([word_a, word_b], alignments)
+    ]
 
 
 def get_reweight_word_indices(
@@ -40,18 +42,9 @@ def get_reweight_word_indices(
 def get_refine_word_indices(
     model: ModelProxy, prompts: list[str]
 ) -> tuple[list[str], list[int]]:
-    token_groups = get_tokens(model, prompts)
-
-    indices = []
-    for i, token_i in enumerate(token_groups[0]):
-        for j, token_j in enumerate(token_groups[1]):
-            if token_i.startswith("<") or token_j.startswith("<"):
-                continue
-
-            if token_i == token_j:
-                indices.append((i, j))
+    alignment_a, alignment_b = get_alignments(model, prompts)
 
-    return list(zip(*indices))
+    return list(zip(*alignment_a.get_matching_indices(alignment_b)))
 
 
 def get_ignore_indices(
@@ -1,3 +1,6 @@
+from numbers import Real
+from typing import Optional, Union
+
 import torch
 
 from editgen._base_controller import BaseController
@@ -6,6 +9,82 @@ from editgen._model import ModelProxy
 
 
 class BaseEditController(BaseController):
+    # The parameters that take one value per edited row
+    row_parameters = ()
+
+    def reset(self):
+        super().reset()
+
+        self._tensors = {}
+
+    def injects_self_attention(self) -> bool:
+        return True
+
+    def get_num_rows(self) -> Optional[int]:
+        for name in self.row_parameters:
+            value = getattr(self, name)
+            if not isinstance(value, Real):
+                return len(value)
+
+        return None
+
+    def get_index(self, indices: list[int], device) -> torch.Tensor:
+        key = ("index", tuple(indices), device)
+        if key not in self._tensors:
+            self._tensors[key] = torch.as_tensor(
+                indices, dtype=torch.long, device=device
+            )
+
+        return self._tensors[key]
+
+    def get_row_parameter(
+        self, value: Union[float, list[float]], attn_weights: torch.Tensor
+    ) -> Union[float, torch.Tensor]:
+        # One value per edited row, broadcast over heads and positions
+        if isinstance(value, Real):
+            return value
+
+        device, dtype = attn_weights.device, attn_weights.dtype
+
+        key = ("parameter", tuple(value), device, dtype)
+        if key not in self._tensors:
+            self._tensors[key] = torch.as_tensor(
+                value, device=device, dtype=dtype
+            ).view(-1, 1, 1, 1)
+
+        return self._tensors[key]
+
+    def get_column_scale(
+        self,
+        indices: list[int],
+        value: float,
+        default: Union[float, list[float]],
+        attn_weights: torch.Tensor,
+    ) -> torch.Tensor:
+        # `value` for the columns in `indices` and `default` for every other column,
+        # with a row of columns per edited row when `default` is a list
+        src_len, device, dtype = (
+            attn_weights.shape[-1],
+            attn_weights.device,
+            attn_weights.dtype,
+        )
+
+        rows = not isinstance(default, Real)
+
+        key = ("scale", tuple(indices), value, src_len, device, dtype)
+        key += (tuple(default) if rows else default,)
+        if key not in self._tensors:
+            if rows:
+                scale = self.get_row_parameter(default, attn_weights)
+                scale = scale.expand(-1, 1, 1, src_len).clone()
+            else:
+                scale = torch.full((src_len,), default, device=device, dtype=dtype)
+
+            scale[..., self.get_index(indices, device)] = value
+            self._tensors[key] = scale
+
+        return self._tensors[key]
+
     def replace_self_attention(self, attn):
         attn_base, att_replace = attn[0], attn[1:]
 
@@ -25,8 +104,22 @@ class IgnoreWordController(BaseEditController):
 
         self.indices = indices
 
+    def caches_cross_attention(self) -> bool:
+        return True
+
+    def edit_cross_cache(self, key_states, value_states):
+        # Zeroing attention columns after the softmax is the same as zeroing the value
+        # rows they select, which are projected once per generation
+        start = 0 if self.source is not None else 1
+        h1 = value_states.shape[0] // 2
+
+        indices = self.get_index(self.indices, value_states.device)
+        value_states[start:h1, :, indices] = 0
+
+        return key_states, value_states
+
     def replace_cross_attention(self, attn_weights, is_cross, attention_type):
-        attn_weights[1:, :, :, self.indices] = 0
+        attn_weights[1:] *= self.get_column_scale(self.indices, 0, 1, attn_weights)
 
         return attn_weights
 
@@ -42,68 +135,92 @@ class IgnoreWordController(BaseEditController):
 
 
 class ReplaceWordController(BaseEditController):
-    def __init__(self, indices: list[list[int]], blend: float = 0.5):
+    row_parameters = ("blend",)
+
+    def __init__(
+        self, indices: list[list[int]], blend: Union[float, list[float]] = 0.5
+    ):
         super().__init__()
 
         self.source_indices, self.target_indices = indices
         self.blend = blend
 
     def replace_cross_attention(self, attn_weights, is_cross, attention_type):
-        source_attn = attn_weights[0, :, :, self.source_indices]
+        source_indices = self.get_index(self.source_indices, attn_weights.device)
+        target_indices = self.get_index(self.target_indices, attn_weights.device)
+
+        source_attn = attn_weights[0, :, :, source_indices]
         averaged_attn = source_attn.mean(dim=-1, keepdims=True)
 
         # Repeat averaged attention values to match dimensions of the target attention
         averaged_attn_repeated = averaged_attn.expand(-1, -1, len(self.target_indices))
 
-        attn_weights[1:, :, :, self.target_indices] = (1 - self.blend) * attn_weights[
-            1:, :, :, self.target_indices
-        ] + self.blend * averaged_attn_repeated
+        blend = self.get_row_parameter(self.blend, attn_weights)
+
+        attn_weights[1:, :, :, target_indices] = (1 - blend) * attn_weights[
+            1:, :, :, target_indices
+        ] + blend * averaged_attn_repeated
 
         return attn_weights
 
 
 class RefineController(BaseEditController):
-    def __init__(self, indices: list[list[int]], blend: float = 0.5):
+    row_parameters = ("blend",)
+
+    def __init__(
+        self, indices: list[list[int]], blend: Union[float, list[float]] = 0.5
+    ):
         super().__init__()
 
         self.source_indices, self.target_indices = indices
         self.blend = blend
 
     def replace_cross_attention(self, attn_weights, is_cross, attention_type):
-        attn_weights[1:, :, :, self.target_indices] = (1 - self.blend) * attn_weights[
-            1:, :, :, self.target_indices
-        ] + self.blend * attn_weights[0, :, :, self.source_indices]
+        source_indices = self.get_index(self.source_indices, attn_weights.device)
+        target_indices = self.get_index(self.target_indices, attn_weights.device)
+
+        blend = self.get_row_parameter(self.blend, attn_weights)
+
+        attn_weights[1:, :, :, target_indices] = (1 - blend) * attn_weights[
+            1:, :, :, target_indices
+        ] + blend * attn_weights[0, :, :, source_indices]
 
         return attn_weights
 
 
 class ReweightWordController(BaseEditController):
-    def __init__(self, indices: list[int], weight: float = 5):
+    row_parameters = ("weight",)
+
+    def __init__(self, indices: list[int], weight: Union[float, list[float]] = 5):
         super().__init__()
 
         self.indices = indices
         self.weight = weight
 
     def replace_cross_attention(self, attn_weights, is_cross, attention_type):
-        attn_weights[1:] = attn_weights[0]
+        if isinstance(self.weight, Real):
+            default = 1 / self.weight
+        else:
+            default = [1 / weight for weight in self.weight]
+
+        scale = self.get_column_scale(self.indices, 1, default, attn_weights)
 
-        non_target_indices = [
-            i for i in range(attn_weights.shape[-1]) if i not in self.indices
-        ]
-        attn_weights[1:, :, :, non_target_indices] /= self.weight
+        attn_weights[1:] = attn_weights[0] * scale
 
         return attn_weights
 
 
 class ReplaceController(BaseEditController):
-    def __init__(self, blend: float = 0.5):
+    row_parameters = ("blend",)
+
+    def __init__(self, blend: Union[float, list[float]] = 0.5):
         super().__init__()
 
         self.blend = blend
 
     def replace_cross_attention(self, attn_weights, is_cross, attention_type):
-        attn_weights[1:] = (1 - self.blend) * attn_weights[
-            1:
-        ] + self.blend * attn_weights[0]
+        blend = self.get_row_parameter(self.blend, attn_weights)
+
+        attn_weights[1:] = (1 - blend) * attn_weights[1:] + blend * attn_weights[0]
 
         return attn_weights
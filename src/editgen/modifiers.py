@@ -1,4 +1,7 @@
-from typing import Any
+from typing import Any, Optional
+
+import numpy as np
+import torch
 
 from editgen._base_controller import BaseController
 
@@ -21,6 +24,24 @@ class ControllerModifier(BaseController):
 
         return setattr(self.controller, name, value)
 
+    def reset(self):
+        self.controller.reset()
+
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        return self.controller.requires_attention(is_cross, attention_type)
+
+    def injects_self_attention(self) -> bool:
+        return self.controller.injects_self_attention()
+
+    def edit_cross_cache(self, key_states, value_states):
+        return self.controller.edit_cross_cache(key_states, value_states)
+
+    def get_num_rows(self) -> Optional[int]:
+        return self.controller.get_num_rows()
+
+    def _compile(self, steps, layers, is_cross):
+        return _compile(self.controller, steps, layers, is_cross)
+
 
 class OffsetControllerModifier(ControllerModifier):
     def __init__(self, controller: BaseController, offset: float = 0.0) -> None:
@@ -30,6 +51,12 @@ class OffsetControllerModifier(ControllerModifier):
 
         self.offset = offset
 
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        if self.cur_step < round(self.offset * self.max_new_tokens):
+            return False
+
+        return self.controller.requires_attention(is_cross, attention_type)
+
     def replace_self_attention(self, attn):
         if self.cur_step < round(self.offset * self.max_new_tokens):
             return attn
@@ -44,6 +71,12 @@ class OffsetControllerModifier(ControllerModifier):
             attn_weights, is_cross, attention_type
         )
 
+    def _compile(self, steps, layers, is_cross):
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+        weights = weights * (steps >= round(self.offset * self.max_new_tokens))
+
+        return weights, heads
+
 
 class AttentionHeadControllerModifier(ControllerModifier):
     def __init__(
@@ -66,11 +99,31 @@ class AttentionHeadControllerModifier(ControllerModifier):
 
         return attn_weights
 
+    def _compile(self, steps, layers, is_cross):
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+
+        indices = np.asarray(self.attention_head_indices)
+        heads = indices if heads is None else indices[heads]
+
+        return weights, heads
+
 
 class SelfAttentionLerpControllerModifier(ControllerModifier):
     def __init__(self, controller: BaseController) -> None:
         super().__init__(controller)
 
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        if not is_cross:
+            return True
+
+        return self.controller.requires_attention(is_cross, attention_type)
+
+    def injects_self_attention(self) -> bool:
+        return False
+
+    def caches_cross_attention(self) -> bool:
+        return self.controller.caches_cross_attention()
+
     def replace_self_attention(self, attn):
         blend = self.cur_att_layer / self.num_att_layers
 
@@ -83,6 +136,18 @@ class SelfAttentionLerpControllerModifier(ControllerModifier):
             attn_weights, is_cross, attention_type
         )
 
+    def _compile(self, steps, layers, is_cross):
+        if not _leaf(self.controller).injects_self_attention():
+            raise ValueError(
+                f"{type(self).__name__} requires a controller that injects "
+                "self-attention"
+            )
+
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+        weights = np.where(is_cross, weights, layers / self.num_att_layers)
+
+        return weights, heads
+
 
 class SelfAttentionCutoffControllerModifier(ControllerModifier):
     def __init__(self, controller: BaseController, threshold: float = 0.75) -> None:
@@ -92,6 +157,17 @@ class SelfAttentionCutoffControllerModifier(ControllerModifier):
 
         self.threshold = threshold
 
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        if not is_cross and self.cur_att_layer > np.floor(
+            self.threshold * self.num_att_layers
+        ):
+            return False
+
+        return self.controller.requires_attention(is_cross, attention_type)
+
+    def caches_cross_attention(self) -> bool:
+        return self.controller.caches_cross_attention()
+
     def replace_self_attention(self, attn):
         if self.cur_att_layer <= np.floor(self.threshold * self.num_att_layers):
             return self.controller.replace_self_attention(attn)
@@ -103,11 +179,22 @@ class SelfAttentionCutoffControllerModifier(ControllerModifier):
             attn_weights, is_cross, attention_type
         )
 
+    def _compile(self, steps, layers, is_cross):
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+        weights = weights * (
+            is_cross | (layers <= np.floor(self.threshold * self.num_att_layers))
+        )
+
+        return weights, heads
+
 
 class AttentionLerpControllerModifier(ControllerModifier):
     def __init__(self, controller: BaseController) -> None:
         super().__init__(controller)
 
+    def injects_self_attention(self) -> bool:
+        return False
+
     def replace_self_attention(self, attn):
         blend = self.cur_att_layer / self.num_att_layers
 
@@ -126,6 +213,12 @@ class AttentionLerpControllerModifier(ControllerModifier):
 
         return attn_weights
 
+    def _compile(self, steps, layers, is_cross):
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+        weights = weights * (1 - layers / self.num_att_layers)
+
+        return weights, heads
+
 
 class AttentionCutoffControllerModifier(ControllerModifier):
     def __init__(self, controller: BaseController, threshold: float = 0.75) -> None:
@@ -135,6 +228,12 @@ class AttentionCutoffControllerModifier(ControllerModifier):
 
         self.threshold = threshold
 
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        if self.cur_att_layer > np.floor(self.threshold * self.num_att_layers):
+            return False
+
+        return self.controller.requires_attention(is_cross, attention_type)
+
     def replace_self_attention(self, attn):
         if self.cur_att_layer <= np.floor(self.threshold * self.num_att_layers):
             return self.controller.replace_self_attention(attn)
@@ -149,6 +248,12 @@ class AttentionCutoffControllerModifier(ControllerModifier):
 
         return attn_weights
 
+    def _compile(self, steps, layers, is_cross):
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+        weights = weights * (layers <= np.floor(self.threshold * self.num_att_layers))
+
+        return weights, heads
+
 
 class DecoderLayerControllerModifier(ControllerModifier):
     def __init__(
@@ -158,6 +263,12 @@ class DecoderLayerControllerModifier(ControllerModifier):
 
         self.decoder_layer_indices = decoder_layer_indices
 
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        if self.cur_att_layer not in self.decoder_layer_indices:
+            return False
+
+        return self.controller.requires_attention(is_cross, attention_type)
+
     def replace_self_attention(self, attn):
         if self.cur_att_layer in self.decoder_layer_indices:
             return self.controller.replace_self_attention(attn)
@@ -171,3 +282,104 @@ class DecoderLayerControllerModifier(ControllerModifier):
             )
 
         return attn_weights
+
+    def _compile(self, steps, layers, is_cross):
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+        weights = weights * np.isin(layers, list(self.decoder_layer_indices))
+
+        return weights, heads
+
+
+class CompiledController(BaseController):
+    def __init__(self, controller: BaseController) -> None:
+        super().__init__()
+
+        self.controller = controller
+
+    def reset(self):
+        super().reset()
+
+        self._weights = []
+        self._heads = None
+
+    def prepare(self, batch_size, max_new_tokens, num_att_layers) -> None:
+        super().prepare(batch_size, max_new_tokens, num_att_layers)
+
+        self.controller.prepare(batch_size, max_new_tokens, num_att_layers)
+
+        # The counters every attention call observes once it has stepped
+        calls = np.arange(1, max_new_tokens * num_att_layers + 1)
+        steps, layers = np.divmod(calls, num_att_layers)
+        is_cross = layers % 2 == 0
+
+        weights, heads = _compile(self.controller, steps, layers, is_cross)
+
+        self._weights = np.broadcast_to(weights, calls.shape).astype(float).tolist()
+        self._heads = heads.tolist() if heads is not None else None
+
+    def requires_attention(self, is_cross, attention_type) -> bool:
+        return self._weight() != 0
+
+    def injects_self_attention(self) -> bool:
+        return self.controller.injects_self_attention()
+
+    def get_num_rows(self) -> Optional[int]:
+        return self.controller.get_num_rows()
+
+    def replace_self_attention(self, attn):
+        weight = self._weight()
+
+        edited = _leaf(self.controller).replace_self_attention(attn)
+        if weight == 1:
+            return edited
+
+        return torch.lerp(attn, edited, weight)
+
+    def replace_cross_attention(self, attn_weights, is_cross, attention_type):
+        weight = self._weight()
+
+        attn = attn_weights
+        if self._heads is not None:
+            attn = attn_weights[:, self._heads]
+
+        edited = _leaf(self.controller).replace_cross_attention(
+            attn.clone() if weight != 1 else attn, is_cross, attention_type
+        )
+        if weight != 1:
+            edited = torch.lerp(attn, edited, weight)
+
+        if self._heads is None:
+            return edited
+
+        attn_weights[:, self._heads] = edited
+
+        return attn_weights
+
+    def _weight(self) -> float:
+        call_index = self.call_index
+        if call_index >= len(self._weights):
+            return 0.0
+
+        return self._weights[call_index]
+
+
+def _leaf(controller: BaseController) -> BaseController:
+    while isinstance(controller, ControllerModifier):
+        controller = controller.controller
+
+    return controller
+
+
+def _compile(
+    controller: BaseController, steps, layers, is_cross
+) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    if isinstance(controller, ControllerModifier):
+        return controller._compile(steps, layers, is_cross)
+
+    weights = np.where(
+        is_cross,
+        float(controller.requires_attention(True, "cross")),
+        float(controller.requires_attention(False, "self")),
+    )
+
+    return weights, None
@@ -0,0 +1,97 @@
+import pytest
+import torch
+from transformers import (
+    BatchEncoding,
+    EncodecConfig,
+    MusicgenConfig,
+    MusicgenDecoderConfig,
+    MusicgenForConditionalGeneration,
+    T5Config,
+)
+
+import editgen._model
+from editgen import EditGenPipeline
+
+
+class WhitespaceProcessor(object):
+    def __init__(self) -> None:
+        self.vocab = {}
+
+    def __call__(self, text, padding=True, return_tensors="pt", **kwargs):
+        input_ids = [
+            [self._get_id(word) for word in item.split()] + [1] for item in text
+        ]
+        length = max(map(len, input_ids))
+
+        return BatchEncoding(
+            {
+                "input_ids": torch.tensor(
+                    [item + [0] * (length - len(item)) for item in input_ids]
+                ),
+                "attention_mask": torch.tensor(
+                    [[1] * len(item) + [0] * (length - len(item)) for item in input_ids]
+                ),
+            }
+        )
+
+    def _get_id(self, word: str) -> int:
+        return self.vocab.setdefault(word, len(self.vocab) + 2)
+
+
+def get_tiny_model(num_codebooks: int) -> MusicgenForConditionalGeneration:
+    torch.manual_seed(0)
+
+    config = MusicgenConfig.from_sub_models_config(
+        T5Config(
+            vocab_size=100, d_model=16, d_kv=4, d_ff=32, num_layers=1, num_heads=4
+        ),
+        EncodecConfig(
+            target_bandwidths=[2.0 * num_codebooks],
+            audio_channels=1,
+            num_filters=4,
+            hidden_size=8,
+            codebook_size=32,
+            codebook_dim=8,
+            upsampling_ratios=[2, 2],
+            sampling_rate=800,
+            num_residual_layers=1,
+        ),
+        MusicgenDecoderConfig(
+            vocab_size=32,
+            hidden_size=16,
+            num_hidden_layers=2,
+            ffn_dim=32,
+            num_attention_heads=4,
+            num_codebooks=num_codebooks,
+            max_position_embeddings=256,
+            pad_token_id=32,
+            bos_token_id=32,
+            decoder_start_token_id=32,
+        ),
+    )
+    model = MusicgenForConditionalGeneration(config).eval()
+
+    model.generation_config.pad_token_id = 32
+    model.generation_config.bos_token_id = 32
+    model.generation_config.decoder_start_token_id = 32
+
+    return model
+
+
+@pytest.fixture
+def get_pipeline(monkeypatch):
+    def get_pipeline(num_codebooks: int = 2, audio_length: float = 0.1):
+        monkeypatch.setattr(
+            editgen._model.AutoProcessor,
+            "from_pretrained",
+            lambda *args, **kwargs: WhitespaceProcessor(),
+        )
+        monkeypatch.setattr(
+            editgen._model.MusicgenForConditionalGeneration,
+            "from_pretrained",
+            lambda *args, **kwargs: get_tiny_model(num_codebooks),
+        )
+
+        return EditGenPipeline("tiny", audio_length=audio_length)
+
+    return get_pipeline
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+import editgen._base_controller
+from editgen._base_controller import AttentionStore, StreamingAttentionStore
+
+PROMPTS = ("pop song with guitar", "pop song with synth")
+
+
+@pytest.mark.unit
+def test_offloaded_mean_includes_the_final_step(get_pipeline, monkeypatch):
+    pipeline = get_pipeline()
+
+    # Keep what gets offloaded, as it would have been copied to the host
+    offloaded = []
+
+    def to_host(tensor):
+        offloaded.append(tensor.clone())
+
+        return tensor
+
+    monkeypatch.setattr(editgen._base_controller, "_to_host", to_host)
+
+    store = AttentionStore()
+    pipeline(store, *PROMPTS)
+
+    streaming_store = StreamingAttentionStore(offload=True)
+    pipeline(streaming_store, *PROMPTS)
+
+    self_sums, cross_sums = offloaded
+    num_steps = pipeline.max_new_tokens
+
+    torch.testing.assert_close(
+        cross_sums / num_steps, store.get_cross_attention().mean(dim=0)
+    )
+    torch.testing.assert_close(
+        self_sums / num_steps, store.get_self_attention().mean(dim=0)
+    )
+    torch.testing.assert_close(
+        streaming_store.get_cross_attention()[0],
+        store.get_cross_attention().mean(dim=0),
+    )
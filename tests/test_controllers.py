@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import torch
+
+from editgen.controllers import ReplaceController, ReweightWordController
+from editgen.modifiers import OffsetControllerModifier
+
+PROMPTS = ("pop song with guitar", "pop song with synth")
+
+
+@pytest.mark.unit
+def test_numpy_scalars_are_scalar_parameters():
+    attn_weights = torch.rand(3, 4, 1, 6)
+
+    controller = ReplaceController(np.linspace(0, 1, 5)[2])
+    controller.reset()
+    assert controller.get_row_parameter(controller.blend, attn_weights) == 0.5
+
+    controller = ReweightWordController([1], np.float32(2))
+    controller.reset()
+    scale = controller.get_column_scale([1], 1, 1 / controller.weight, attn_weights)
+    torch.testing.assert_close(scale, torch.tensor([0.5, 1, 0.5, 0.5, 0.5, 0.5]))
+
+    assert controller.get_num_rows() is None
+
+
+@pytest.mark.unit
+def test_sweep_accepts_numpy_parameters(get_pipeline):
+    pipeline = get_pipeline()
+    controller = ReplaceController(list(np.linspace(0, 1, 3)))
+
+    audio_values = pipeline.sweep(controller, PROMPTS[0], PROMPTS[1], 3)
+
+    assert audio_values.shape[0] == 4
+
+
+@pytest.mark.unit
+def test_sweep_rejects_mismatched_parameters(get_pipeline):
+    pipeline = get_pipeline()
+    controller = OffsetControllerModifier(ReweightWordController([1], [2, 4]), 0.5)
+
+    with pytest.raises(ValueError, match="one parameter per edited row"):
+        pipeline.sweep(controller, PROMPTS[0], PROMPTS[1], 3)
@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from auffusion.converter import (
+    AttrDict,
+    Generator,
+    SpectrogramFrontend,
+    hann_window,
+    mel_basis,
+    mel_spectrogram,
+)
+
+CONFIG = AttrDict(
+    num_mels=8,
+    upsample_initial_channel=8,
+    resblock="1",
+    upsample_rates=[2],
+    upsample_kernel_sizes=[4],
+    resblock_kernel_sizes=[3],
+    resblock_dilation_sizes=[[1, 3, 5]],
+)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("value, expected", [(100.0, 32767), (-100.0, -32768)])
+def test_full_scale_samples_are_clipped(value, expected):
+    vocoder = Generator(CONFIG)
+    # The output saturates tanh at exactly full scale
+    vocoder.conv_post.bias.data.fill_(value)
+
+    wavs = vocoder.synthesize(torch.rand(1, 8, 4))
+
+    assert wavs.dtype == torch.int16
+    assert (wavs == expected).all()
+
+
+def get_frontend(**kwargs) -> SpectrogramFrontend:
+    return SpectrogramFrontend(64, 16, 16000, 16, 64, 0, 8000, **kwargs)
+
+
+@pytest.mark.unit
+def test_batched_mel_spectrogram_matches_single_items():
+    y = torch.rand(2, 3, 512) * 2 - 1
+
+    spec = get_frontend()(y)
+
+    assert spec.shape[:2] == (2, 3)
+    for i in range(2):
+        for j in range(3):
+            expected = mel_spectrogram(y[i, j][None], 64, 16, 16000, 16, 64, 0, 8000)
+            torch.testing.assert_close(spec[i, j], expected[0])
+
+
+@pytest.mark.unit
+def test_filterbank_and_window_are_cached():
+    frontend = get_frontend()
+    frontend(torch.rand(1, 512))
+    basis, window = frontend.get_mel_basis("cpu"), frontend.get_window("cpu")
+    num_bases, num_windows = len(mel_basis), len(hann_window)
+
+    frontend(torch.rand(1, 512))
+    get_frontend()(torch.rand(2, 512))
+
+    assert frontend.get_mel_basis("cpu") is basis
+    assert frontend.get_window("cpu") is window
+    assert (len(mel_basis), len(hann_window)) == (num_bases, num_windows)
+
+
+@pytest.mark.unit
+def test_out_of_range_samples_are_recorded():
+    frontend = get_frontend(check_range=True)
+
+    frontend(torch.full((1, 512), 0.5))
+    frontend(torch.full((1, 512), -1.5))
+    frontend(torch.full((1, 512), 0.25))
+
+    assert frontend.max_amplitude.item() == 1.5
@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from auffusion.prompt2prompt.ptp_utils import LocalBlend
+
+PROMPTS = ["a photo of a cat", "a photo of a dog"]
+
+
+def get_blend(resolution_factor: int) -> LocalBlend:
+    blend = LocalBlend(
+        PROMPTS, [[], []], None, "cpu", resolution_factor=resolution_factor
+    )
+    blend.alpha_layers[:, 1] = 1
+
+    return blend
+
+
+def update(blend: LocalBlend, height: int, width: int) -> None:
+    num_queries = height * width
+    attn = torch.rand(len(PROMPTS) * 2, num_queries, 77)
+
+    blend.update(attn, "down", slice(0, num_queries), num_queries, (16, 64))
+
+
+@pytest.mark.unit
+def test_rectangular_latents_are_blended():
+    blend = get_blend(4)
+    update(blend, 4, 16)
+
+    x_t = torch.rand(len(PROMPTS), 4, 16, 64)
+    blended = blend(x_t, None)
+
+    assert blended.shape == x_t.shape
+    torch.testing.assert_close(blended[0], x_t[0])
+
+
+@pytest.mark.unit
+def test_missing_blending_resolution_is_reported():
+    blend = get_blend(8)
+    update(blend, 4, 16)
+
+    with pytest.raises(ValueError, match="2x8"):
+        blend(torch.rand(len(PROMPTS), 4, 16, 64), None)
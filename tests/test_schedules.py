@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+from auffusion.prompt2prompt.ptp_utils import AttentionControlEdit
+
+PROMPTS = ["a photo of a cat", "a photo of a dog"]
+
+NUM_STEPS = (10, 25, 30, 50)
+
+BOUNDS = (0.1, 0.55, 0.8, 0.95, 1.0, (0.2, 0.65), (0.35, 0.85))
+
+
+class EditAll(AttentionControlEdit):
+    def __init__(self, cross_replace_steps, self_replace_steps, num_steps=100):
+        super().__init__(
+            PROMPTS,
+            num_steps,
+            cross_replace_steps,
+            self_replace_steps,
+            None,
+            None,
+            "cpu",
+            torch.float32,
+        )
+        self.query_slice = slice(0, 16)
+        self.num_queries = 16
+
+    def replace_cross_attention(self, attn_base, att_replace):
+        return torch.ones_like(att_replace)
+
+    def replace_self_attention(self, attn_base, att_replace):
+        return torch.ones_like(att_replace)
+
+
+def get_window(bounds, num_steps):
+    if type(bounds) is float:
+        bounds = 0, bounds
+    return int(bounds[0] * num_steps), int(bounds[1] * num_steps)
+
+
+def get_edited_steps(controller: EditAll, num_steps: int, is_cross: bool):
+    # The pipeline tells the controller how many steps it runs
+    controller.num_steps = num_steps
+    edited = []
+    for step in range(num_steps):
+        controller.denoising_step = step
+        attn = torch.zeros(len(PROMPTS), 16, 77 if is_cross else 16)
+        attn = controller.edit_attention(attn, is_cross, "down")
+        edited.append(bool(attn[1:].any()))
+
+    return edited
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("num_steps", NUM_STEPS)
+@pytest.mark.parametrize("bounds", BOUNDS)
+def test_cross_replace_schedule_matches_step_schedule(num_steps, bounds):
+    controller = EditAll({"default_": bounds}, 0.0)
+
+    # The cross-attention schedule has one row more than there are steps
+    start, end = get_window(bounds, num_steps + 1)
+    expected = [start <= step < end for step in range(num_steps)]
+
+    assert get_edited_steps(controller, num_steps, is_cross=True) == expected
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("num_steps", NUM_STEPS)
+@pytest.mark.parametrize("bounds", BOUNDS)
+def test_self_replace_schedule_matches_step_schedule(num_steps, bounds):
+    controller = EditAll(0.0, bounds)
+
+    start, end = get_window(bounds, num_steps)
+    expected = [start <= step < end for step in range(num_steps)]
+
+    assert get_edited_steps(controller, num_steps, is_cross=False) == expected
+
+
+@pytest.mark.unit
+def test_higher_order_schedulers_share_a_step():
+    controller = EditAll(0.55, 0.0, num_steps=10)
+
+    # Heun calls the UNet twice for each step but the last
+    edited = []
+    for i in range(2 * 10 - 1):
+        controller.denoising_step = i // 2
+        attn = controller.edit_attention(torch.zeros(2, 16, 77), True, "down")
+        edited.append(bool(attn[1:].any()))
+
+    assert edited == [i // 2 < int(0.55 * 11) for i in range(2 * 10 - 1)]
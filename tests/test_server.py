@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from editgen._server import EditServer
+
+
+class FakePipeline(object):
+    audio_length = 1.0
+
+    def __init__(self, delay: float = 0.01) -> None:
+        self.delay = delay
+        self.batch_sizes = []
+
+    def get_max_new_tokens(self, audio_length: float) -> int:
+        return int(audio_length * 50)
+
+    def batch(self, *jobs, audio_length: float):
+        time.sleep(self.delay)
+        self.batch_sizes.append(sum(len(prompts) for _, prompts in jobs))
+
+        return [prompts for _, prompts in jobs]
+
+
+@pytest.mark.unit
+def test_sustained_load_keeps_executing_batches():
+    pipeline = FakePipeline()
+    server = EditServer(pipeline, max_batch_size=4, max_wait=0.05)
+
+    futures = []
+    with server:
+        started = time.monotonic()
+        while time.monotonic() - started < 0.5:
+            futures.append(server.submit(None, f"prompt {len(futures)}"))
+
+            # Submit faster than `max_wait`, so that admission never times out
+            time.sleep(0.01)
+
+            # Batches must run while requests are still arriving
+            if time.monotonic() - started > 0.25:
+                assert pipeline.batch_sizes
+
+        for index, future in enumerate(futures):
+            assert future.result(timeout=5) == [f"prompt {index}"]
+
+    assert max(pipeline.batch_sizes) <= 4
+
+
+@pytest.mark.unit
+def test_full_batch_does_not_wait():
+    pipeline = FakePipeline(delay=0.0)
+    server = EditServer(pipeline, max_batch_size=2, max_wait=10.0)
+
+    with server:
+        futures = [server.submit(None, "a", "b")]
+
+        assert futures[0].result(timeout=1) == ["a", "b"]
+
+
+@pytest.mark.unit
+def test_submit_requires_a_running_server():
+    pipeline = FakePipeline(delay=0.0)
+    server = EditServer(pipeline)
+
+    with pytest.raises(RuntimeError, match="not running"):
+        server.submit(None, "a")
+
+    with server:
+        future = server.submit(None, "a")
+
+    assert future.result(timeout=1) == ["a"]
+    with pytest.raises(RuntimeError, match="not running"):
+        server.submit(None, "b")
+
+
+@pytest.mark.unit
+def test_stop_cancels_stranded_requests():
+    pipeline = FakePipeline(delay=0.0)
+    server = EditServer(pipeline)
+
+    server.start()
+    future = server.submit(None, "a")
+    # A request that arrived behind the sentinel would never be served
+    server._queue.put(None)
+    stranded = server.submit(None, "b")
+    server.stop()
+
+    assert future.result(timeout=1) == ["a"]
+    assert stranded.cancelled()
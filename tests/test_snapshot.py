@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+PROMPTS = ("pop song with guitar", "pop song with synth")
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("num_codebooks", [2, 4])
+def test_fork_matches_generation_at_the_step_bounds(get_pipeline, num_codebooks):
+    pipeline = get_pipeline(num_codebooks)
+    audio_values = pipeline(None, *PROMPTS)
+
+    min_step = num_codebooks - 1
+    max_step = pipeline.max_new_tokens - num_codebooks + 1
+    for step in (min_step, max_step):
+        snapshot = pipeline.snapshot(None, *PROMPTS, step=step)
+
+        np.testing.assert_array_equal(pipeline.fork(snapshot, None), audio_values)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("num_codebooks", [2, 4])
+def test_snapshot_rejects_steps_out_of_bounds(get_pipeline, num_codebooks):
+    pipeline = get_pipeline(num_codebooks)
+
+    for step in (num_codebooks - 2, pipeline.max_new_tokens - num_codebooks + 2):
+        with pytest.raises(ValueError, match="Expected a step"):
+            pipeline.snapshot(None, *PROMPTS, step=step)